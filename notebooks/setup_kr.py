@@ -33,21 +33,17 @@ run_id = run_list[0]
 instructions = dict(
     event_rate=5,  # Don't make too large -> overlapping truth info
     chunk_size=5,  # keep large -> less overhead but takes more RAM
-    nchunk=100,  # set to 100
-    photons_low=1,  # PE
-    photons_high=100,  # PE
-    electrons_low=1,  #
-    electrons_high=100,
+    n_chunk=100,  # set to 100
     tpc_radius=straxen.tpc_r,
     tpc_length=straxen.tpc_z,  # TPC length approx
     drift_field=straxen.get_resource('fax_config_nt_low_field.json', fmt='json').get('drift_field'),
-    timing='uniform',  # Double S1 peaks uniform over time
 )
 
 pema.inst_to_csv(
-    instructions,
     instructions_csv,
-    get_inst_from=pema.kr83_instructions)
+    get_inst_from=pema.kr83_instructions,
+    **instructions,
+)
 
 config_update = dict(
     detector='XENONnT',
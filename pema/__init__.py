@@ -8,4 +8,5 @@ from .wfsim_utils import *
 from .scripts import *
 from .contexts import *
 from .misc import *
+from .warmup import *
 from .compare_plots import *
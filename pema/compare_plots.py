@@ -160,7 +160,7 @@ def _plot_peak(st_default,
         seconds_range_xaxis(xlim)
         plt.xlim(*xlim)
     plt.text(0.05, 0.95,
-             truth_vs_default[peak_i]['outcome'],
+             pema.outcome_label(truth_vs_default[peak_i]['outcome']),
              transform=plt.gca().transAxes,
              ha='left',
              va='top',
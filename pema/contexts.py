@@ -17,6 +17,8 @@ def pema_context(
         raw_dir=None,
         data_dir=None,
         raw_types=None,
+        fuse_truth_extended=False,
+        npy_instructions=None,
         **kwargs,
 ) -> strax.Context:
     """
@@ -30,6 +32,14 @@ def pema_context(
     :param data_dir: Where to store the high level datatypes
     :param raw_types: Low level datatypes, stored separately from
         high level datatypes
+    :param fuse_truth_extended: provide truth_extended with
+        FusedTruthExtended (matching and acceptance in one pass)
+        instead of merging truth_matched and match_acceptance
+    :param npy_instructions: provide raw_records with
+        RawRecordsFromFaxNpy, which also reads .npy instructions (see
+        pema.inst_to_file). This changes the lineage of raw_records, so
+        by default (None) only if the fax_file in the config is a .npy
+        file. Set to True to set a .npy fax_file later.
 
     :kwargs: any kwargs are directly passed to the context
     :return: context
@@ -64,6 +74,11 @@ def pema_context(
     # Setup the plugins for nT
     # st.register(wfsim.RawRecordsFromFaxNT)
     st.register_all(pema.match_plugins)
+    st.register(pema.FusedTruthExtended if fuse_truth_extended else pema.TruthExtended)
+    if npy_instructions is None:
+        npy_instructions = str(config.get('fax_file', '')).endswith('.npy')
+    if npy_instructions:
+        st.register(pema.RawRecordsFromFaxNpy)
     st._plugin_class_registry['peaks'].save_when = strax.SaveWhen.ALWAYS
 
     if raw_types is None:
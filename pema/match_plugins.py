@@ -1,7 +1,6 @@
 import warnings
 
 import strax
-import numba
 import numpy as np
 import pema
 import logging
@@ -14,53 +13,255 @@ log = logging.getLogger('Pema matching')
 
 
 @export
-class MatchPeaks(strax.OverlapWindowPlugin):
+class AdaptiveWindowMixin:
     """
-    Match WFSim truth to the outcome peaks. To this end use the
-        matching algorithm of pema. Assign a peak-id to both the truth
-        and the reconstructed peaks to be able to match the two. Also
-        define the outcome of the matching (see pema.matching for
-        possible outcomes).
+    Mixin for an OverlapWindowPlugin to derive the window from the data.
+    With adapt_lookup_window, the window is twice the longest interval
+    seen so far (see max_length) plus the matching_fuzz instead of the
+    truth_lookup_window, which then only sets the maximum window. If a
+    later chunk has a longer interval than the inputs cached for it
+    cover, the truth_lookup_window is used from then on.
+
+    This is not a strax.Plugin itself so that it is not registered by
+    register_all. The configs are added to those of the plugins using it.
     """
-    __version__ = '0.5.0'
-    depends_on = ('truth', 'truth_id', 'peak_basics', 'peak_id')
-    provides = 'truth_matched'
-    data_kind = 'truth'
+    max_length_seen = 0
+    # Set once an interval did not fit the adapted window
+    window_exceeded = False
+    # Fuzz [ns] of the matching, see pema.match_peak_columns
+    matching_fuzz = 0
 
     truth_lookup_window = straxen.URLConfig(
         default=int(1e9),
         help='Look back and forth this many ns in the truth info',
     )
+    adapt_lookup_window = straxen.URLConfig(
+        default=False,
+        help='Derive the window from the longest interval in the data, '
+             'truth_lookup_window is then the maximum window',
+    )
+
+    def do_compute(self, chunk_i=None, **kwargs):
+        if self.config['adapt_lookup_window'] and not self.window_exceeded:
+            length = self.max_length(**{kind: chunk.data for kind, chunk in kwargs.items()})
+            if len(self.cached_input) and length > self.get_window_size():
+                # The inputs cached at the previous chunk may be too
+                # short to match intervals this long
+                log.info(f'{self.__class__.__name__} got an interval of {length} ns, more '
+                         f'than the adapted window of {self.get_window_size()} ns, use '
+                         f'the truth_lookup_window from now on')
+                self.window_exceeded = True
+            self.max_length_seen = max(self.max_length_seen, length)
+        return super().do_compute(chunk_i=chunk_i, **kwargs)
+
+    def get_window_size(self):
+        if self.config['adapt_lookup_window'] and not self.window_exceeded:
+            return int(min(2 * (self.max_length_seen + self.matching_fuzz) + 1,
+                           self.config['truth_lookup_window']))
+        return self.config['truth_lookup_window']
+
+    def max_length(self, **kwargs) -> int:
+        """
+        Longest interval in the inputs of a chunk, using the endtime
+        that the matching uses (the clean_endtime of the truth)
+        """
+        return max([int(np.max(matching_endtime(data) - data['time'], initial=0))
+                    for data in kwargs.values()],
+                   default=0)
+
+
+def matching_endtime(data):
+    """Endtime of the intervals, also covering the clean_endtime used for matching"""
+    if 'clean_endtime' in data.dtype.names:
+        return np.maximum(data['clean_endtime'], strax.endtime(data))
+    return strax.endtime(data)
+
+
+@export
+class MatchPeaks(AdaptiveWindowMixin, strax.OverlapWindowPlugin):
+    """
+    Match WFSim truth to the outcome peaks. To this end use the
+        matching algorithm of pema. Assign a peak-id to both the truth
+        and the reconstructed peaks to be able to match the two. Also
+        define the outcome of the matching (see pema.matching for
+        possible outcomes). The results are provided for the truth
+        (truth_matched) and the peaks (peaks_matched).
+    """
+    __version__ = '0.8.0'
+    depends_on = ('truth', 'truth_id', 'truth_clean', 'peak_basics', 'peak_id')
+    provides = ('truth_matched', 'peaks_matched')
+    data_kind = dict(truth_matched='truth', peaks_matched='peaks')
+
+    matching_n_threads = straxen.URLConfig(
+        default=1, track=False,
+        help='Match independent clusters of truth and peaks in this many threads',
+    )
+    add_pair_metrics = straxen.URLConfig(
+        default=False,
+        help='Add the overlap fraction and the start, end and center time offsets '
+             'of the matched peak to truth_matched (see pema.pair_metrics)',
+    )
 
     def compute(self, truth, peaks):
         log.debug(f'Starting {self.__class__.__name__}')
-        truth = pema.append_fields(truth, 'area', truth['raw_area'])
+        result = match_truth_to_peaks(truth, peaks, self.config['matching_n_threads'],
+                                      self.matching_fuzz)
+
+        res_truth = np.zeros(len(truth), dtype=self.dtype_for('truth_matched'))
+        res_truth['time'] = truth['time']
+        res_truth['endtime'] = truth['clean_endtime']
+        res_truth['id'] = truth['id']
+        res_truth['outcome'] = result.outcome1
+        res_truth['matched_to'] = result.matched_to1
+        if self.config['add_pair_metrics']:
+            fill_pair_metrics(res_truth, truth, peaks, result.matched_to1)
+
+        res_peaks = np.zeros(len(peaks), dtype=self.dtype_for('peaks_matched'))
+        res_peaks['time'] = peaks['time']
+        res_peaks['endtime'] = strax.endtime(peaks)
+        res_peaks['id'] = peaks['id']
+        res_peaks['outcome'] = result.outcome2
+        res_peaks['matched_to'] = result.matched_to2
+        return dict(truth_matched=res_truth, peaks_matched=res_peaks)
+
+    def infer_dtype(self):
+        truth_dtype = matched_dtype('truth', 'peaks')
+        if self.config['add_pair_metrics']:
+            truth_dtype += PAIR_METRICS_FIELDS
+        return dict(truth_matched=truth_dtype,
+                    peaks_matched=matched_dtype('peaks', 'truth'))
+
+
+def matched_dtype(kind, other_kind):
+    """Dtype of the matching result of <kind> to <other_kind>"""
+    return strax.dtypes.time_fields + [
+        ((f'Id of element in {kind}', 'id'), np.int64),
+        ((f'Outcome of matching to {other_kind}', 'outcome'),
+         pema.matching.OUTCOME_DTYPE),
+        ((f'Id of matching element in {other_kind}', 'matched_to'), np.int64)
+    ]
 
-        # hack endtime
-        log.warning(f'Patching endtime in the truth')
-        truth['endtime'] = truth['t_last_photon'].copy()
 
-        log.info('Starting matching')
-        truth_vs_peak, peak_vs_truth = pema.match_peaks(truth, peaks)
+# Fields of the truth with add_pair_metrics, see fill_pair_metrics
+PAIR_METRICS_FIELDS = [
+    (('Fraction of the truth that overlaps with the matched peak',
+      'overlap_fraction'), np.float32),
+    (('Start time of the matched peak minus that of the truth [ns]',
+      'start_offset'), np.int64),
+    (('Endtime of the matched peak minus that of the truth [ns]',
+      'end_offset'), np.int64),
+    (('Center time of the matched peak minus the mean photon time [ns]',
+      'center_offset'), np.float64),
+]
 
-        # copy to the result buffer
-        res_truth = np.zeros(len(truth), dtype=self.dtype)
-        for k in self.dtype.names:
-            res_truth[k] = truth_vs_peak[k]
 
-        return res_truth
+def fill_pair_metrics(res, truth, peaks, matched_to):
+    """
+    Fill the PAIR_METRICS_FIELDS in res for the truth (with the
+    truth_id and truth_clean fields) matched to the peaks, see
+    pema.pair_metrics
+    """
+    metrics = pema.pair_metrics(dict(time=truth['time'],
+                                     endtime=truth['clean_endtime'],
+                                     id=truth['id'],
+                                     center_time=truth['t_mean_photon']),
+                                peaks,
+                                matched_to)
+    for field in metrics.dtype.names:
+        res[field] = metrics[field]
+
+
+def match_truth_to_peaks(truth, peaks, n_threads=1, matching_fuzz=0):
+    """
+    Match the truth (with the truth_id and truth_clean fields) to the
+    peaks (with the peak_id fields), see pema.match_peak_columns
+    """
+    truth_columns = dict(time=truth['time'],
+                         endtime=truth['clean_endtime'],
+                         id=truth['id'],
+                         type=truth['type'],
+                         area=truth['raw_area'])
+    log.info('Starting matching')
+    # TruthClean already checked the truth
+    return pema.match_peak_columns(truth_columns, peaks,
+                                   matching_fuzz=matching_fuzz,
+                                   n_threads=n_threads,
+                                   checked=(True, False))
 
-    def get_window_size(self):
-        return self.config['truth_lookup_window']
+
+@export
+class TruthFragments(AdaptiveWindowMixin, strax.OverlapWindowPlugin):
+    """
+    Store all the peaks that overlap with the truth if there are several
+    (e.g. for split or chopped truth), where truth_matched only has the
+    largest of them. There is one row per truth and peak, the rows of
+    each truth are consecutive (see pema.fragment_table).
+    """
+    __version__ = '0.0.0'
+    depends_on = ('truth', 'truth_id', 'truth_clean', 'peak_basics', 'peak_id')
+    provides = 'truth_fragments'
+    data_kind = 'truth_fragments'
+
+    dtype = strax.dtypes.time_fields + [
+        ((f'Id of element in truth', 'id'), np.int64),
+        ((f'Id of overlapping element in peaks', 'fragment_id'), np.int64),
+        ((f'Fraction of the truth that overlaps with the peak', 'overlap_fraction'),
+         np.float32),
+    ]
+
+    def compute(self, truth, peaks):
+        table = pema.fragment_table(dict(time=truth['time'],
+                                         endtime=truth['clean_endtime'],
+                                         id=truth['id']),
+                                    peaks)
+        truth_i = np.repeat(np.arange(len(truth)), np.diff(table.offsets))
+        res = np.zeros(len(truth_i), self.dtype)
+        res['time'] = truth['time'][truth_i]
+        res['endtime'] = truth['clean_endtime'][truth_i]
+        res['id'] = truth['id'][truth_i]
+        res['fragment_id'] = table.fragment_id
+        res['overlap_fraction'] = table.overlap_fraction
+        return res
+
+
+@export
+class TruthClean(strax.Plugin):
+    """
+    Check the truth once before matching (see pema.preflight_peaks)
+    and store the endtime to use for matching (the time of the last
+    photon) together with the flags of the checks. The matching of
+    plugins depending on truth_clean does not check the truth again.
+    """
+    __version__ = '0.1.0'
+    depends_on = ('truth', 'truth_id')
+    provides = 'truth_clean'
+    data_kind = 'truth'
 
     def infer_dtype(self):
         dtype = strax.dtypes.time_fields + [
-            ((f'Id of element in truth', 'id'), np.int64),
-            ((f'Outcome of matching to peaks', 'outcome'), pema.matching.OUTCOME_DTYPE),
-            ((f'Id of matching element in peaks', 'matched_to'), np.int64)
+            ((f'Endtime of the truth used for matching (time of the last photon)',
+              'clean_endtime'), np.int64),
+            ((f'Flags of the preflight checks, see pema.matching.PREFLIGHT_*',
+              'preflight_flags'), pema.matching.PREFLIGHT_DTYPE),
         ]
         return dtype
 
+    def compute(self, truth):
+        report = pema.preflight_peaks(truth['time'], truth['t_last_photon'], truth['id'])
+        if not report.is_sorted:
+            raise ValueError('truth is not sorted!')
+        if not report.unique_ids:
+            raise ValueError('truth has duplicate ids!')
+        if not report.valid_intervals:
+            log.warning(f'{report.n_negative_length} truth rows have no photons after '
+                        f'their start, these can not be matched')
+        res = np.zeros(len(truth), dtype=self.dtype)
+        res['time'] = truth['time']
+        res['endtime'] = strax.endtime(truth)
+        res['clean_endtime'] = truth['t_last_photon']
+        res['preflight_flags'] = report.flags
+        return res
+
 
 @export
 class AcceptanceComputer(strax.Plugin):
@@ -71,7 +272,7 @@ class AcceptanceComputer(strax.Plugin):
     an S2 into small S1 signals that could affect event
     reconstruction).
     """
-    __version__ = '2.0.2'
+    __version__ = '2.1.0'
     depends_on = ('truth', 'truth_matched', 'peak_basics', 'peak_id')
     provides = 'match_acceptance'
     data_kind = 'truth'
@@ -96,69 +297,117 @@ class AcceptanceComputer(strax.Plugin):
         res = np.zeros(len(truth), self.dtype)
         res['time'] = truth['time']
         res['endtime'] = strax.endtime(truth)
-        res['is_found'] = truth['outcome'] == 'found'
-
-        peak_idx = truth['matched_to']
-        mask = peak_idx != INT_NAN
-        if np.sum(mask):
-            # need to get at least one peak for each, even if we are going to remove those later
-            sel_from_peaks = peak_idx[mask]
-            sel_peaks = peaks[get_idx(sel_from_peaks, peaks['id'], INT_NAN)]
-
-            if len(sel_peaks) != len(sel_from_peaks):
-                raise ValueError(f'Got {len(sel_peaks)} != {len(sel_from_peaks)}')
-            not_match = sel_from_peaks != sel_peaks['id']
-            if np.any(not_match):
-                for i, t_i, p_i in zip(not_match, sel_from_peaks, sel_peaks['id']):
-                    print(i, t_i, p_i)
-                raise ValueError
-            for k in self.keep_peak_fields:
-                res[f'rec_{k}'][mask] = sel_peaks[k]
-
-        res['rec_bias'] = res['rec_area'] / truth['raw_area']
-
-        # S1 acceptance is simply is the peak found or not
-        s1_mask = truth['type'] == 1
-        res['acceptance_fraction'][s1_mask] = res['is_found'][s1_mask].astype(np.float64)
-
-        # For the S2 acceptance we calculate an arbitrary acceptance
-        # that takes into account penalty factors and that S2s may be
-        # split (as long as their bias fraction is not too small).
-        s2_mask = truth['type'] == 2
-        s2_outcomes = truth['outcome'][s2_mask].copy()
-        s2_acceptance = (res[s2_mask]['rec_bias'] > self.config['min_s2_bias_rec']).astype(
-            np.float64)
-        for outcome, penalty in self.config['penalty_s2_by']:
-            s2_out_mask = s2_outcomes == outcome
-            s2_acceptance[s2_out_mask] = penalty
-
-        # now update the acceptance fraction in the results
-        res['acceptance_fraction'][s2_mask] = s2_acceptance
-
+        fill_acceptance(res, truth, peaks,
+                        keep_peak_fields=self.keep_peak_fields,
+                        penalty_s2_by=self.config['penalty_s2_by'],
+                        min_s2_bias_rec=self.config['min_s2_bias_rec'])
         return res
 
     def infer_dtype(self):
-        dtype = strax.dtypes.time_fields + [
-            ((f'Is the peak tagged "found" in the reconstructed data',
-              'is_found'), np.bool_),
-            ((f'Acceptance of the peak can be negative for penalized reconstruction',
-              'acceptance_fraction'),
-             np.float64),
-            ((f'Reconstruction bias 1 is perfect, 0.1 means incorrect',
-              'rec_bias'),
-             np.float64),
-        ]
-        for descr in self.deps['peak_basics'].dtype_for('peak_basics').descr:
-            # Add peak fields
-            field = descr[0][1]
-            if field in self.keep_peak_fields:
-                dtype += [((descr[0][0], f'rec_{field}'), descr[1])]
-        return dtype
+        return acceptance_dtype(self.deps['peak_basics'].dtype_for('peak_basics'),
+                                self.keep_peak_fields)
 
     def setup(self):
         assert 'area' in self.keep_peak_fields
 
 
+def acceptance_dtype(peak_basics_dtype, keep_peak_fields):
+    """Dtype of the acceptance, with the rec_ fields of peak_basics"""
+    dtype = strax.dtypes.time_fields + [
+        ((f'Is the peak tagged "found" in the reconstructed data',
+          'is_found'), np.bool_),
+        ((f'Acceptance of the peak can be negative for penalized reconstruction',
+          'acceptance_fraction'),
+         np.float64),
+        ((f'Reconstruction bias 1 is perfect, 0.1 means incorrect',
+          'rec_bias'),
+         np.float64),
+    ]
+    for descr in peak_basics_dtype.descr:
+        # Add peak fields
+        field = descr[0][1]
+        if field in keep_peak_fields:
+            dtype += [((descr[0][0], f'rec_{field}'), descr[1])]
+    return dtype
+
+
+def fill_acceptance(res, truth, peaks, keep_peak_fields, penalty_s2_by, min_s2_bias_rec):
+    """
+    Fill the fields of acceptance_dtype in res for the matched truth
+    (with the outcome and matched_to fields). See AcceptanceComputer.
+    """
+    res['is_found'] = truth['outcome'] == pema.matching.OUTCOME_FOUND
+
+    peak_idx = truth['matched_to']
+    mask = peak_idx != INT_NAN
+    if np.sum(mask):
+        peak_i = id_to_index(peak_idx[mask], peaks['id'])
+        for k in keep_peak_fields:
+            res[f'rec_{k}'][mask] = peaks[k][peak_i]
+
+    res['rec_bias'] = res['rec_area'] / truth['raw_area']
+    res['acceptance_fraction'] = _acceptance_fractions(
+        truth['type'], truth['outcome'], res['rec_bias'],
+        [min_s2_bias_rec], [penalty_s2_by])[0, 0]
+
+
+@export
+def acceptance_sweep(truth_extended, min_s2_bias_recs, penalty_s2_bys) -> np.ndarray:
+    """
+    Compute the acceptance_fraction of AcceptanceComputer for a grid of
+    settings at once, without reprocessing. Only the acceptance_fraction
+    depends on min_s2_bias_rec and penalty_s2_by, the matching and
+    rec_bias are taken from the (stored) truth_extended.
+
+    Example:
+        truth = st.get_array(run_id, 'truth_extended')
+        acc = pema.acceptance_sweep(truth, [0.8, 0.85, 0.9],
+                                    [(('misid_as_s1', -1.),), ()])
+        # acceptance for penalty_s2_by=() and min_s2_bias_rec=0.9
+        acc[1, 2]
+
+    :param truth_extended: array with the type, outcome and rec_bias fields
+    :param min_s2_bias_recs: values of min_s2_bias_rec
+    :param penalty_s2_bys: values of penalty_s2_by, each a tuple of
+        (outcome, penalty_factor) tuples
+    :return: acceptance_fraction of shape (len(penalty_s2_bys),
+        len(min_s2_bias_recs), len(truth_extended))
+    """
+    return _acceptance_fractions(truth_extended['type'],
+                                 truth_extended['outcome'],
+                                 truth_extended['rec_bias'],
+                                 min_s2_bias_recs,
+                                 penalty_s2_bys)
+
+
+def _acceptance_fractions(truth_type, outcome, rec_bias, min_s2_bias_recs, penalty_s2_bys):
+    """Acceptance fraction for each penalty_s2_by and min_s2_bias_rec"""
+    min_s2_bias_recs = np.asarray(min_s2_bias_recs, dtype=np.float64)
+    res = np.zeros((len(penalty_s2_bys), len(min_s2_bias_recs), len(truth_type)),
+                   dtype=np.float64)
+
+    # S1 acceptance is simply is the peak found or not
+    s1_mask = truth_type == 1
+    res[:, :, s1_mask] = outcome[s1_mask] == pema.matching.OUTCOME_FOUND
+
+    # For the S2 acceptance we calculate an arbitrary acceptance
+    # that takes into account penalty factors and that S2s may be
+    # split (as long as their bias fraction is not too small).
+    s2_mask = truth_type == 2
+    s2_outcomes = outcome[s2_mask]
+    s2_acceptance = rec_bias[s2_mask][np.newaxis, :] > min_s2_bias_recs[:, np.newaxis]
+    for penalty_i, penalty_s2_by in enumerate(penalty_s2_bys):
+        # Later penalties take precedence, as if they are set one by one
+        penalty = np.zeros(len(s2_outcomes), dtype=np.float64)
+        penalized = np.zeros(len(s2_outcomes), dtype=np.bool_)
+        for outcome_name, penalty_factor in penalty_s2_by:
+            s2_out_mask = s2_outcomes == pema.matching.outcome_code(outcome_name)
+            penalty[s2_out_mask] = penalty_factor
+            penalized |= s2_out_mask
+        res[penalty_i][:, s2_mask] = np.where(penalized, penalty, s2_acceptance)
+    return res
+
+
 class AcceptanceExtended(strax.MergeOnlyPlugin):
     """Merge the matched acceptance to the extended truth"""
     __version__ = '0.1.0'
@@ -183,7 +432,144 @@ class TruthExtended(strax.MergeOnlyPlugin):
     save_when = strax.SaveWhen.TARGET
 
 
-class MatchEvents(strax.OverlapWindowPlugin):
+@export
+class FusedTruthExtended(AdaptiveWindowMixin, strax.OverlapWindowPlugin):
+    """
+    Provide truth_extended in one pass: match the truth to the peaks and
+    compute the acceptance (see MatchPeaks and AcceptanceComputer)
+    without storing or loading the intermediate datatypes. This loads
+    the peaks once instead of twice. Use pema_context(...,
+    fuse_truth_extended=True) to register it instead of TruthExtended.
+    """
+    __version__ = '0.0.0'
+    depends_on = ('truth', 'truth_id', 'truth_clean', 'peak_basics', 'peak_id')
+    provides = 'truth_extended'
+    data_kind = 'truth'
+    save_when = strax.SaveWhen.TARGET
+
+    matching_n_threads = straxen.URLConfig(
+        default=1, track=False,
+        help='Match independent clusters of truth and peaks in this many threads',
+    )
+    add_pair_metrics = straxen.URLConfig(
+        default=False,
+        help='Add the overlap fraction and the start, end and center time offsets '
+             'of the matched peak (see pema.pair_metrics), as MatchPeaks does',
+    )
+    keep_peak_fields = straxen.URLConfig(
+        default=('area', 'range_50p_area', 'area_fraction_top', 'rise_time', 'tight_coincidence'),
+        help='Add the reconstructed value of these variables',
+    )
+    penalty_s2_by = straxen.URLConfig(
+        default=(('misid_as_s1', -1.), ('split_and_misid', -1.),),
+        help='Add a penalty to the acceptance fraction if the peak has the '
+             'outcome. Should be tuple of tuples where each tuple should '
+             'have the format of (outcome, penalty_factor)',
+    )
+    min_s2_bias_rec = straxen.URLConfig(
+        default=0.85,
+        help='If the S2 fraction is greater or equal than this, consider a '
+             'peak successfully found even if it is split or chopped.',
+    )
+
+    def infer_dtype(self):
+        # Same fields as merging match_acceptance, truth, truth_id and
+        # truth_matched (see TruthExtended)
+        return strax.merged_dtype([
+            np.dtype(acceptance_dtype(self.deps['peak_basics'].dtype_for('peak_basics'),
+                                      self.keep_peak_fields)),
+            self.deps['truth'].dtype_for('truth'),
+            self.deps['truth_id'].dtype_for('truth_id'),
+            np.dtype(matched_dtype('truth', 'peaks') +
+                     (PAIR_METRICS_FIELDS if self.config['add_pair_metrics'] else [])),
+        ])
+
+    def setup(self):
+        assert 'area' in self.keep_peak_fields
+
+    def compute(self, truth, peaks):
+        result = match_truth_to_peaks(truth, peaks, self.config['matching_n_threads'],
+                                      self.matching_fuzz)
+
+        res = np.zeros(len(truth), self.dtype)
+        for field in res.dtype.names:
+            if field in truth.dtype.names:
+                res[field] = truth[field]
+        res['outcome'] = result.outcome1
+        res['matched_to'] = result.matched_to1
+        if self.config['add_pair_metrics']:
+            fill_pair_metrics(res, truth, peaks, result.matched_to1)
+        fill_acceptance(res, res, peaks,
+                        keep_peak_fields=self.keep_peak_fields,
+                        penalty_s2_by=self.config['penalty_s2_by'],
+                        min_s2_bias_rec=self.config['min_s2_bias_rec'])
+        # When merging, the endtime of truth_matched takes precedence
+        res['endtime'] = truth['clean_endtime']
+        return res
+
+
+@export
+def peak_join_plugin(join_fields: dict,
+                     provides: str = 'truth_peaks_joined',
+                     prefix: str = 'rec_') -> type:
+    """
+    Make a plugin that adds fields of peaks-kind datatypes to the truth.
+    For each truth row, the fields of the matched peak (matched_to) are
+    gathered. Truth rows without a matched peak are zero.
+
+    Example:
+        st.register(pema.peak_join_plugin({'peak_positions': ('x', 'y')}))
+        st.get_array(run_id, ('truth_extended', 'truth_peaks_joined'))
+
+    :param join_fields: dict of {data_type: fields} of the peaks-kind
+        datatypes to add to the truth
+    :param provides: name of the datatype that is provided
+    :param prefix: prefix of the fields in the provided datatype
+    :return: plugin class to register to the context
+    """
+    join_fields = {data_type: strax.to_str_tuple(fields)
+                   for data_type, fields in join_fields.items()}
+
+    class PeakJoin(strax.Plugin):
+        __doc__ = f'Add {join_fields} of the matched peak to the truth'
+        # Different fields (or their names) should give a different lineage
+        __version__ = '0.0.0-' + strax.deterministic_hash(dict(join_fields=join_fields,
+                                                                prefix=prefix))
+        depends_on = ('truth_matched', 'peak_id') + tuple(join_fields)
+        data_kind = 'truth'
+
+        def infer_dtype(self):
+            # Copy, the fields are added in place
+            dtype = strax.dtypes.time_fields.copy()
+            for data_type, fields in join_fields.items():
+                peaks_dtype = self.deps[data_type].dtype_for(data_type)
+                for field in fields:
+                    if field not in peaks_dtype.names:
+                        raise ValueError(f'{data_type} has no field {field}')
+                    # Fields without a title have no third item
+                    field_dtype, _, *title = peaks_dtype.fields[field]
+                    title = title[0] if title else field
+                    dtype += [((f'{title} of the matched peak', f'{prefix}{field}'),
+                               field_dtype)]
+            return dtype
+
+        def compute(self, truth, peaks):
+            res = np.zeros(len(truth), self.dtype)
+            res['time'] = truth['time']
+            res['endtime'] = strax.endtime(truth)
+            mask = truth['matched_to'] != INT_NAN
+            if np.any(mask):
+                peak_i = id_to_index(truth['matched_to'][mask], peaks['id'])
+                for fields in join_fields.values():
+                    for field in fields:
+                        res[f'{prefix}{field}'][mask] = peaks[field][peak_i]
+            return res
+
+    PeakJoin.provides = provides
+    return PeakJoin
+
+
+class MatchEvents(AdaptiveWindowMixin, strax.OverlapWindowPlugin):
     """
     Match WFSim truth to the outcome peaks. To this end use the
         matching algorithm of pema. Assign a peak-id to both the truth
@@ -191,15 +577,11 @@ class MatchEvents(strax.OverlapWindowPlugin):
         define the outcome of the matching (see pema.matching for
         possible outcomes).
     """
-    __version__ = '0.1.0'
+    __version__ = '0.3.0'
     depends_on = ('truth', 'events')
     provides = 'truth_events'
     data_kind = 'truth_events'
 
-    truth_lookup_window = straxen.URLConfig(
-        default=int(1e9),
-        help='Look back and forth this many ns in the truth info',
-    )
     check_event_endtime = straxen.URLConfig(
         default=True,
         help='Check that all events have a non-zero duration.',
@@ -217,10 +599,12 @@ class MatchEvents(strax.OverlapWindowPlugin):
     ]
 
     def compute(self, truth, events):
-        unique_numbers = np.unique(truth[self.sim_id_field])
+        unique_numbers, start, end = group_start_end(
+            truth[self.sim_id_field], truth['time'], truth['endtime'])
         res = np.zeros(len(unique_numbers), self.dtype)
         res['truth_number'] = unique_numbers
-        fill_start_end(truth, res)
+        res['time'] = start
+        res['endtime'] = end
         if self.check_event_endtime:
             assert np.all(res['endtime'] > res['time'])
         assert np.all(np.diff(res['time']) > 0)
@@ -240,8 +624,11 @@ class MatchEvents(strax.OverlapWindowPlugin):
         res['outcome'] = self.outcomes(diff)
         return res
 
-    def get_window_size(self):
-        return self.config['truth_lookup_window']
+    def max_length(self, truth, events) -> int:
+        """Longest truth event (group of truth rows) or event"""
+        _, start, end = group_start_end(truth[self.sim_id_field], truth['time'], truth['endtime'])
+        return max(int(np.max(end - start, initial=0)),
+                   int(np.max(strax.endtime(events) - events['time'], initial=0)))
 
     @staticmethod
     def outcomes(diff):
@@ -250,20 +637,23 @@ class MatchEvents(strax.OverlapWindowPlugin):
         not_found_mask = diff < 1
         one_found_mask = diff == 1
         many_found_mask = diff > 1
-        outcome[not_found_mask] = 'missed'
-        outcome[one_found_mask] = 'found'
-        outcome[many_found_mask] = 'split'
+        outcome[not_found_mask] = pema.matching.OUTCOME_MISSED
+        outcome[one_found_mask] = pema.matching.OUTCOME_FOUND
+        outcome[many_found_mask] = pema.matching.OUTCOME_SPLIT
         return outcome
 
 
 class PeakId(strax.Plugin):
-    """Add id field to datakind"""
+    """
+    Add id field to datakind. The id is derived from the time (see
+    ids_from_time) so that it does not depend on the other chunks.
+    """
     depends_on = 'peak_basics'
     provides = 'peak_id'
     data_kind = 'peaks'
-    __version__ = '0.0.0'
+    __version__ = '0.1.0'
+    parallel = 'process'
 
-    peaks_seen = 0
     save_when = strax.SaveWhen.TARGET
 
     def infer_dtype(self):
@@ -271,13 +661,11 @@ class PeakId(strax.Plugin):
         id_field = [((f'Id of element in {self.data_kind}', 'id'), np.int64), ]
         return dtype + id_field
 
-    def compute(self, peaks):
+    def compute(self, peaks, start, end):
         res = np.zeros(len(peaks), dtype=self.dtype)
         res['time'] = peaks['time']
         res['endtime'] = peaks['endtime']
-        peak_id = np.arange(len(peaks)) + self.peaks_seen
-        res['id'] = peak_id
-        self.peaks_seen += len(peaks)
+        res['id'] = ids_from_time(peaks['time'], end, start)
         return res
 
 
@@ -285,53 +673,102 @@ class TruthId(PeakId):
     depends_on = 'truth'
     provides = 'truth_id'
     data_kind = 'truth'
-    __version__ = '0.0.0'
+    __version__ = '0.1.0'
 
-    def compute(self, truth):
-        assert_ordered_truth(truth)
-        return super().compute(truth)
+    def compute(self, truth, start, end):
+        # TruthClean checks that the truth is sorted
+        return super().compute(truth, start, end)
 
 
-def fill_start_end(truth, truth_event, end_field='endtime'):
-    """Set the 'time' and 'endtime' fields based on the truth"""
-    truth_number = truth['event_number']
-    starts = truth['time']
-    stops = truth[end_field]
-    _fill_start_end(truth_number, stops, starts, truth_event)
+@export
+def ids_from_time(time, end=None, start=None) -> np.ndarray:
+    """
+    Get unique, increasing ids from sorted times. The id is the time
+    itself, unless an earlier item already has that id, then it is one
+    more than the id of the previous item. Ids that would reach the end
+    of the chunk are shifted back into the gap before it, e.g. for
+    zero-length items at the end or items with a negative length (see
+    TruthClean) starting after it. The ids are also unique and
+    increasing if the times are not sorted, but then do not follow the
+    times.
+
+    :param time: sorted times of the items in a chunk
+    :param end: end of the chunk, ids stay below this to be unique
+        with respect to the ids of the next chunk
+    :param start: start of the chunk, ids should stay at or above this
+        to be unique with respect to the ids of the previous chunk
+    """
+    rank = np.arange(len(time), dtype=np.int64)
+    ids = np.maximum.accumulate(np.asarray(time, dtype=np.int64) - rank) + rank
+    if end is not None:
+        ids = np.minimum(ids, end - len(ids) + rank)
+    if start is not None and len(ids) and ids[0] < start:
+        raise ValueError(f'Too many items in the chunk to get unique ids '
+                         f'(id {ids[0]} < start {start})')
+    return ids
 
 
-@numba.njit()
-def _fill_start_end(truth_number, stops, starts, truth_event):
-    for i, ev_i in enumerate(truth_event['truth_number']):
-        mask = truth_number == ev_i
-        start = starts[mask].min()
-        stop = stops[mask].max()
-        truth_event['time'][i] = start
-        truth_event['endtime'][i] = stop
+def fill_start_end(truth, truth_event, end_field='endtime', id_field='event_number'):
+    """
+    Set the 'time' and 'endtime' fields based on the truth. The
+    truth_number of the truth_event may be any subset of the id_field
+    of the truth, in any order.
+    """
+    unique_numbers, start, end = group_start_end(truth[id_field], truth['time'], truth[end_field])
+    event_i = np.searchsorted(unique_numbers, truth_event['truth_number'])
+    event_i = event_i.clip(0, max(len(unique_numbers) - 1, 0))
+    if len(truth_event) and (not len(unique_numbers) or
+                             np.any(unique_numbers[event_i] != truth_event['truth_number'])):
+        raise ValueError(f'truth_number of truth_event is not in the {id_field} of truth')
+    truth_event['time'] = start[event_i]
+    truth_event['endtime'] = end[event_i]
 
 
-def assert_ordered_truth(truth):
-    assert np.all(np.diff(truth['time']) >= 0), "truth is not sorted!"
+def group_start_end(truth_number, starts, stops):
+    """
+    Get the unique truth numbers and the first start and last stop of
+    each of them. The truth numbers are usually sorted already, if not,
+    they are sorted once.
 
+    :returns: unique truth numbers, start and stop of each
+    """
+    if len(truth_number) and np.any(np.diff(truth_number) < 0):
+        order = np.argsort(truth_number, kind='stable')
+        truth_number, starts, stops = truth_number[order], starts[order], stops[order]
+    if not len(truth_number):
+        return truth_number, starts, stops
+    group_starts = np.concatenate([[0], np.flatnonzero(np.diff(truth_number)) + 1])
+    return (truth_number[group_starts],
+            np.minimum.reduceat(starts, group_starts),
+            np.maximum.reduceat(stops, group_starts))
 
-@numba.njit
-def get_idx(search_item, in_list, not_found=-99999):
-    """Get index in <in_list> where the value is <searc_value>
 
-    Assumes that <in_list> is sorted!
+@export
+def id_to_index(search_ids, ids) -> np.ndarray:
+    """
+    Get the index in <ids> of each of the <search_ids>
 
-    :returns:
-        a list of length (search item) where each value refers to the item in <in_list>
+    Uses a binary search, <ids> are sorted already if assigned by
+    PeakId (see ids_from_time), otherwise they are sorted first.
+    <search_ids> may be in any order.
+    :raises ValueError: if any of the <search_ids> is not in <ids>
     """
-    result = np.ones(len(search_item), dtype=np.int64) * not_found
-    look_from = 0
-    for i, search in enumerate(search_item):
-        for k, v in enumerate(in_list[look_from:]):
-            if v == search:
-                result[i] = look_from + k
-                look_from += k
-                break
-    for r in result:
-        if r == not_found:
-            raise ValueError()
-    return result
+    search_ids = np.asarray(search_ids)
+    ids = np.asarray(ids)
+    if not len(ids):
+        if len(search_ids):
+            raise ValueError(f'Cannot find {len(search_ids)} ids in empty ids')
+        return np.zeros(0, dtype=np.int64)
+
+    if np.all(np.diff(ids) >= 0):
+        index = np.searchsorted(ids, search_ids)
+    else:
+        order = np.argsort(ids, kind='stable')
+        index = order[np.clip(np.searchsorted(ids[order], search_ids), 0, len(ids) - 1)]
+    index = np.clip(index, 0, len(ids) - 1)
+
+    not_found = ids[index] != search_ids
+    if np.any(not_found):
+        raise ValueError(f'{np.sum(not_found)} ids are not found, '
+                         f'e.g. {search_ids[not_found][:5]}')
+    return index
@@ -5,6 +5,7 @@ import numpy as np
 import strax
 import numba
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from numpy.lib import recfunctions
 
 log = logging.getLogger('Pema matching')
@@ -12,14 +13,169 @@ log = logging.getLogger('Pema matching')
 export, __all__ = strax.exporter()
 
 INT_NAN = -99999
-OUTCOME_DTYPE = '<U32'
+OUTCOME_DTYPE = np.int16
+
+# Integer codes for the outcome of matching. Use outcome_label to get
+# the human-readable string for displaying.
+OUTCOME_MISSED = 0
+OUTCOME_FOUND = 1
+OUTCOME_UNCLASSIFIED = 2
+OUTCOME_MERGED = 3
+OUTCOME_MERGED_TO_UNKNOWN = 4
+OUTCOME_SPLIT = 5
+OUTCOME_CHOPPED = 6
+OUTCOME_SPLIT_AND_UNCLASSIFIED = 7
+OUTCOME_SPLIT_AND_MISID = 8
+# Outcomes that carry the type of the peak in the other list are
+# stored as offset + type, e.g. misid_as_s2 -> MISID_AS_OFFSET + 2
+MISID_AS_OFFSET = 1000
+MERGED_TO_OFFSET = 2000
+MAX_PEAK_TYPE = 999
+
+OUTCOME_LABELS = {
+    OUTCOME_MISSED: 'missed',
+    OUTCOME_FOUND: 'found',
+    OUTCOME_UNCLASSIFIED: 'unclassified',
+    OUTCOME_MERGED: 'merged',
+    OUTCOME_MERGED_TO_UNKNOWN: 'merged_to_unknown',
+    OUTCOME_SPLIT: 'split',
+    OUTCOME_CHOPPED: 'chopped',
+    OUTCOME_SPLIT_AND_UNCLASSIFIED: 'split_and_unclassified',
+    OUTCOME_SPLIT_AND_MISID: 'split_and_misid',
+}
+_OUTCOME_PREFIXES = {MISID_AS_OFFSET: 'misid_as_s', MERGED_TO_OFFSET: 'merged_to_s'}
+
+
+@export
+def outcome_label(code) -> str:
+    """Get the human-readable label of an (integer) outcome code"""
+    if isinstance(code, str):
+        # Data from before outcomes were integer coded
+        return code
+    code = int(code)
+    if code in OUTCOME_LABELS:
+        return OUTCOME_LABELS[code]
+    for offset, prefix in _OUTCOME_PREFIXES.items():
+        if 0 <= code - offset <= MAX_PEAK_TYPE:
+            return prefix + str(code - offset)
+    raise ValueError(f'Unknown outcome code {code}')
+
+
+@export
+def outcome_code(label: str) -> int:
+    """Get the integer code of an outcome label (e.g. 'misid_as_s1')"""
+    for code, known_label in OUTCOME_LABELS.items():
+        if label == known_label:
+            return code
+    for offset, prefix in _OUTCOME_PREFIXES.items():
+        if label.startswith(prefix) and label[len(prefix):].isdigit():
+            peak_type = int(label[len(prefix):])
+            if peak_type <= MAX_PEAK_TYPE:
+                return offset + peak_type
+    raise ValueError(f'Unknown outcome {label}')
+
+
+@export
+def outcome_labels(codes: np.ndarray) -> np.ndarray:
+    """Convert an array of outcome codes to an array of labels"""
+    unique_codes, inverse = np.unique(codes, return_inverse=True)
+    labels = np.array([outcome_label(c) for c in unique_codes], dtype='<U32')
+    return labels[inverse.reshape(np.shape(codes))]
+
+
+# Flags set by preflight_peaks, combined as a bitmask
+PREFLIGHT_UNSORTED = 1
+PREFLIGHT_NEGATIVE_LENGTH = 2
+PREFLIGHT_ZERO_LENGTH = 4
+PREFLIGHT_OVERLAP = 8
+PREFLIGHT_DUPLICATE_ID = 16
+PREFLIGHT_DTYPE = np.int8
+
+
+@export
+class PreflightReport:
+    """
+    Summary of preflight_peaks, tells which assumptions of the matching
+    hold for the peaks.
+    """
+    __slots__ = ('flags', 'is_sorted', 'n_negative_length', 'n_zero_length',
+                 'n_overlapping', 'unique_ids')
+
+    def __init__(self, flags):
+        self.flags = flags
+        self.is_sorted = not np.any(flags & PREFLIGHT_UNSORTED)
+        self.n_negative_length = np.count_nonzero(flags & PREFLIGHT_NEGATIVE_LENGTH)
+        self.n_zero_length = np.count_nonzero(flags & PREFLIGHT_ZERO_LENGTH)
+        self.n_overlapping = np.count_nonzero(flags & PREFLIGHT_OVERLAP)
+        self.unique_ids = not np.any(flags & PREFLIGHT_DUPLICATE_ID)
+
+    @property
+    def valid_intervals(self) -> bool:
+        """Sorted and without negative lengths (as strax.touching_windows requires)"""
+        return self.is_sorted and not self.n_negative_length
+
+    def __repr__(self):
+        return (f'PreflightReport(n={len(self.flags)}, is_sorted={self.is_sorted}, '
+                f'n_negative_length={self.n_negative_length}, '
+                f'n_zero_length={self.n_zero_length}, '
+                f'n_overlapping={self.n_overlapping}, unique_ids={self.unique_ids})')
+
+
+@export
+def preflight_peaks(time, endtime, ids=None) -> PreflightReport:
+    """
+    Check peaks (or truth) in a single pass for: sort order, negative
+    and zero lengths, overlaps with earlier peaks and duplicate ids.
+    The flags of each peak (PREFLIGHT_*) are in the flags of the report.
+    :param time: start times
+    :param endtime: exclusive endtimes
+    :param ids: optional, ids of the peaks
+    """
+    if ids is None:
+        ids = np.zeros(0, dtype=np.int64)
+    return PreflightReport(_preflight_flags(time, endtime, ids))
+
+
+@numba.njit(nogil=True, cache=True)
+def _preflight_flags(time, endtime, ids):
+    n = len(time)
+    flags = np.zeros(n, dtype=PREFLIGHT_DTYPE)
+    check_ids = len(ids) == n
+    ids_sorted = True
+    max_endtime = np.iinfo(np.int64).min
+    for i in range(n):
+        if endtime[i] < time[i]:
+            flags[i] |= PREFLIGHT_NEGATIVE_LENGTH
+        elif endtime[i] == time[i]:
+            flags[i] |= PREFLIGHT_ZERO_LENGTH
+        if i > 0:
+            if time[i] < time[i - 1]:
+                flags[i] |= PREFLIGHT_UNSORTED
+            if time[i] < max_endtime:
+                flags[i] |= PREFLIGHT_OVERLAP
+            if check_ids:
+                if ids[i] == ids[i - 1]:
+                    flags[i] |= PREFLIGHT_DUPLICATE_ID
+                elif ids[i] < ids[i - 1]:
+                    ids_sorted = False
+        max_endtime = max(max_endtime, endtime[i])
+
+    if check_ids and not ids_sorted:
+        # Cannot find the duplicates in one pass, sort the ids instead
+        order = np.argsort(ids, kind='mergesort')
+        for j in range(1, n):
+            if ids[order[j]] == ids[order[j - 1]]:
+                flags[order[j]] |= PREFLIGHT_DUPLICATE_ID
+    return flags
 
 
 @export
 def match_peaks(allpeaks1,
                 allpeaks2,
                 matching_fuzz=0,
-                unknown_types=(0,)):
+                unknown_types=(0,),
+                engine='windows',
+                n_threads=1):
     """
     Perform peak matching between two numpy record arrays with fields:
         time, endtime (or dt and length), id, type, area
@@ -27,9 +183,22 @@ def match_peaks(allpeaks1,
     into three peaks), the results are unreliable and depend on which
     peak set is peaks1 and which is peaks2.
 
+    The engine can be one of:
+        windows: Compute the windows of the overlapping peaks in the
+            other list for each window separately (default).
+        sweep: Compute the overlap structure of both lists in a single
+            pass and assign the outcomes in place. Gives the same
+            outcomes as windows but scales linearly for large windows
+            (e.g. high pile-up S2-trains).
+
+    With n_threads > 1, the peaks are split into clusters of peaks that
+    do not overlap with peaks in other clusters. These clusters are
+    independent and are matched in parallel threads.
+
     Returns (allpeaks1, allpeaks2), each with two extra fields:
     outcome, matched_to:
-        outcome: Can be one of:
+        outcome: Integer code (see OUTCOME_LABELS and outcome_label)
+            of one of:
             found:  Peak was matched 1-1 between peaks1 and peaks2 (type agrees,
              no other peaks in range).
                     Note that area, widths, etc. can still be quite different!
@@ -49,6 +218,8 @@ def match_peaks(allpeaks1,
         matched_to: id of matching in *peak* in the other list if outcome is found
             or misid_as_XX, INT_NAN otherwise.
     """
+    if engine not in ('windows', 'sweep'):
+        raise ValueError(f'Unknown engine {engine}, choose "windows" or "sweep"')
     # Check required fields
     for i, d in enumerate((allpeaks1, allpeaks2)):
         assert hasattr(d, 'dtype'), 'Cannot work with non-numpy arrays'
@@ -63,32 +234,536 @@ def match_peaks(allpeaks1,
     allpeaks1 = append_fields(
         allpeaks1,
         ('outcome', 'matched_to'),
-        (np.array(['missed'] * len(allpeaks1), dtype=OUTCOME_DTYPE),
+        (np.full(len(allpeaks1), OUTCOME_MISSED, dtype=OUTCOME_DTYPE),
          INT_NAN * np.ones(len(allpeaks1), dtype=np.int64)),
         dtypes=(OUTCOME_DTYPE, np.int64),
     )
     allpeaks2 = append_fields(
         allpeaks2,
         ('outcome', 'matched_to'),
-        (np.array(['missed'] * len(allpeaks2), dtype=OUTCOME_DTYPE),
+        (np.full(len(allpeaks2), OUTCOME_MISSED, dtype=OUTCOME_DTYPE),
          INT_NAN * np.ones(len(allpeaks2), dtype=np.int64)),
         dtypes=(OUTCOME_DTYPE, np.int64),
     )
+    # Only pass the fields needed for matching to the kernels, this way
+    # they are compiled once rather than for every dtype of the peaks.
+    compact1 = _gather_match_columns(allpeaks1)
+    compact2 = _gather_match_columns(allpeaks2)
+    _match_in_place(compact1, compact2, matching_fuzz, unknown_types, engine, n_threads)
+    for k in ('outcome', 'matched_to'):
+        allpeaks1[k] = compact1[k]
+        allpeaks2[k] = compact2[k]
+    return allpeaks1, allpeaks2
 
-    log.debug('Getting windows')
-    
-    # FIXME: This is a hack to get around the fact that we trigger bug in _check_objects_non_negative_length for truth
-    # WFSim for unknown reason is generating negative length truth and it is beyond the scope
-    # of this package to fix it. So we just ignore it here and print warning.
-    if np.any(allpeaks1['endtime']<0):
-        log.warning("Negative length truth found, ignoring it and changing the event_number to -1")    
-        windows = strax.processing.general._touching_windows(allpeaks1['time'], strax.endtime(allpeaks1), allpeaks2['time'], 
-                                                         strax.endtime(allpeaks2), window=matching_fuzz)
-        bad_event_numbers = allpeaks1[allpeaks1['endtime']<0]['event_number']
-        for event_number in bad_event_numbers:
-            allpeaks1[allpeaks1['event_number']==event_number]['event_number'] = -1
+
+@export
+class MatchResult:
+    """
+    Outcome and matched_to of peaks1 and peaks2 (see match_peaks),
+    without any of the other fields of the peaks
+    """
+    __slots__ = ('outcome1', 'matched_to1', 'outcome2', 'matched_to2')
+
+    def __init__(self, outcome1, matched_to1, outcome2, matched_to2):
+        self.outcome1 = outcome1
+        self.matched_to1 = matched_to1
+        self.outcome2 = outcome2
+        self.matched_to2 = matched_to2
+
+    def __repr__(self):
+        return f'MatchResult({len(self.outcome1)} peaks1, {len(self.outcome2)} peaks2)'
+
+
+# Only these fields are needed for matching, see match_peak_columns
+MATCH_DTYPE = np.dtype([
+    ('time', np.int64),
+    ('endtime', np.int64),
+    ('id', np.int64),
+    ('type', np.int16),
+    ('area', np.float64),
+    ('outcome', OUTCOME_DTYPE),
+    ('matched_to', np.int64),
+])
+
+
+@export
+def match_peak_columns(columns1,
+                       columns2,
+                       matching_fuzz=0,
+                       unknown_types=(0,),
+                       engine='windows',
+                       n_threads=1,
+                       checked=(False, False)) -> MatchResult:
+    """
+    Perform peak matching (see match_peaks) using only the columns
+    time, endtime, id, type and area of peaks1 and peaks2. Contrary to
+    match_peaks, none of the other fields of the peaks are copied.
+
+    :param columns1: dict of arrays (or array with at least these
+        fields) with keys time, endtime, id, type, area. Use e.g.
+        dict(area=truth['raw_area'], ...) to match on other fields.
+    :param columns2: same for peaks2
+    :param checked: for peaks1 and peaks2, if they are checked with
+        preflight_peaks already (e.g. the truth by TruthClean), in
+        which case they are not checked again
+    :return: MatchResult with outcome and matched_to of both
+    """
+    if engine not in ('windows', 'sweep'):
+        raise ValueError(f'Unknown engine {engine}, choose "windows" or "sweep"')
+    allpeaks1 = _gather_match_columns(columns1)
+    allpeaks2 = _gather_match_columns(columns2)
+    _match_in_place(allpeaks1, allpeaks2, matching_fuzz, unknown_types, engine, n_threads,
+                    checked)
+    return MatchResult(allpeaks1['outcome'], allpeaks1['matched_to'],
+                       allpeaks2['outcome'], allpeaks2['matched_to'])
+
+
+def _gather_match_columns(columns):
+    """
+    Get a compact array of the columns needed for matching (MATCH_DTYPE)
+    from a dict of arrays or an array with (at least) these fields
+    """
+    names = columns.dtype.names if hasattr(columns, 'dtype') else tuple(columns.keys())
+    n = len(columns['time'])
+    res = np.zeros(n, dtype=MATCH_DTYPE)
+    res['outcome'] = OUTCOME_MISSED
+    res['matched_to'] = INT_NAN
+    for k in MATCH_DTYPE.names:
+        if k == 'endtime' and k not in names and hasattr(columns, 'dtype'):
+            # Array with dt and length instead
+            res[k] = strax.endtime(columns)
+            continue
+        if k not in names:
+            if k in ('outcome', 'matched_to'):
+                # Not matched yet
+                continue
+            raise ValueError(f'Column {k} is required for matching')
+        if len(columns[k]) != n:
+            raise ValueError(f'Column {k} has length {len(columns[k])} != {n}')
+        res[k] = columns[k]
+    return res
+
+
+def _check_before_matching(allpeaks1, allpeaks2, checked=(False, False)):
+    """Check that the peaks can be matched (see preflight_peaks)"""
+    for i, peaks in enumerate((allpeaks1, allpeaks2)):
+        if checked[i]:
+            continue
+        report = preflight_peaks(peaks['time'], peaks['endtime'])
+        if not report.is_sorted:
+            raise ValueError(f'Argument {i} is not sorted by time')
+        if report.n_negative_length:
+            # WFSim for unknown reason is generating negative length
+            # truth and it is beyond the scope of this package to fix
+            # it. These peaks are never matched, print a warning.
+            log.warning(f'Argument {i} has {report.n_negative_length} peaks with negative length')
+
+
+@export
+def match_multi_fuzz(columns1,
+                     columns2,
+                     matching_fuzzes,
+                     unknown_types=(0,)) -> dict:
+    """
+    Perform peak matching (see match_peak_columns, with the sweep
+    engine) for several values of matching_fuzz at once. The pairs of
+    peaks in each others windows at the largest matching_fuzz are
+    computed once, together with the smallest matching_fuzz at which
+    they touch. From these, the windows of each matching_fuzz follow
+    without searching again. The windows are grouped into clusters that
+    are independent at all matching_fuzz values, only the clusters with
+    windows that change from one matching_fuzz to the next are matched
+    again. If (nearly) all windows change, e.g. for matching_fuzz values
+    much larger than the time between the peaks, this takes about as
+    long as matching for each matching_fuzz separately.
+
+    :param columns1: dict of arrays (or array) with time, endtime, id,
+        type and area of peaks1
+    :param columns2: same for peaks2
+    :param matching_fuzzes: iterable of matching_fuzz values
+    :return: dict of {matching_fuzz: MatchResult}
+    """
+    allpeaks1 = _gather_match_columns(columns1)
+    allpeaks2 = _gather_match_columns(columns2)
+    _check_before_matching(allpeaks1, allpeaks2)
+    unknown_types = np.array(unknown_types)
+    matching_fuzzes = list(matching_fuzzes)
+    # Windows only grow with matching_fuzz, go from small to large
+    fuzzes = np.unique(matching_fuzzes)
+    if not len(fuzzes):
+        return {}
+
+    # Both windows (peaks1 in the window of each of peaks2) and reverse
+    # windows (peaks2 in the window of each of peaks1), see _match_in_place
+    windows = _FuzzWindows(allpeaks1, allpeaks2, fuzzes)
+    reverse_windows = _FuzzWindows(allpeaks2, allpeaks1, fuzzes)
+    cluster, cluster_ranges = _fuzz_clusters(windows.max_windows, reverse_windows.max_windows)
+    # Changing the reverse window of one of the peaks1 changes its cluster
+    cluster_of_peak1 = np.full(len(allpeaks1), -1, dtype=np.int64)
+    for cluster_i, (l1, r1, _, _) in enumerate(cluster_ranges):
+        cluster_of_peak1[l1:r1] = cluster_i
+
+    outcome1 = np.zeros((len(fuzzes), len(allpeaks1)), dtype=OUTCOME_DTYPE)
+    matched_to1 = np.zeros((len(fuzzes), len(allpeaks1)), dtype=np.int64)
+    outcome2 = np.zeros((len(fuzzes), len(allpeaks2)), dtype=OUTCOME_DTYPE)
+    matched_to2 = np.zeros((len(fuzzes), len(allpeaks2)), dtype=np.int64)
+    for fuzz_i in range(len(fuzzes)):
+        changed = np.zeros(len(cluster_ranges), dtype=np.bool_)
+        for changed_clusters in (cluster[windows.grow(fuzz_i)],
+                                 cluster_of_peak1[reverse_windows.grow(fuzz_i)]):
+            # Windows that do not set any peaks are not in a cluster (-1)
+            changed[changed_clusters[changed_clusters >= 0]] = True
+        if np.any(changed):
+            _reset_clusters(allpeaks1, allpeaks2, cluster_ranges[changed])
+            rematch = np.flatnonzero(changed[cluster] & (cluster >= 0))
+            _match_peaks_sweep(allpeaks1, allpeaks2, windows.windows[rematch],
+                               reverse_windows.windows, unknown_types)
+        outcome1[fuzz_i] = allpeaks1['outcome']
+        matched_to1[fuzz_i] = allpeaks1['matched_to']
+        outcome2[fuzz_i] = allpeaks2['outcome']
+        matched_to2[fuzz_i] = allpeaks2['matched_to']
+
+    results = {}
+    for matching_fuzz in matching_fuzzes:
+        fuzz_i = np.searchsorted(fuzzes, matching_fuzz)
+        results[matching_fuzz] = MatchResult(outcome1[fuzz_i], matched_to1[fuzz_i],
+                                             outcome2[fuzz_i], matched_to2[fuzz_i])
+    return results
+
+
+class _FuzzWindows:
+    """
+    Windows of the things that touch each of the containers (see
+    strax.touching_windows) for increasing values of matching_fuzz
+    """
+
+    def __init__(self, things, containers, fuzzes):
+        self.max_windows = strax.processing.general._touching_windows(
+            things['time'], things['endtime'],
+            containers['time'], containers['endtime'],
+            window=fuzzes[-1]).astype(np.int64)
+        # Things touch a container if the running max of their endtime
+        # reaches the start of the container and they start before its end
+        max_endtime = (np.maximum.accumulate(things['endtime']) if len(things)
+                       else things['endtime'])
+        self.container_i, self.thing_i, self.fuzz_bounds = _pairs_by_first_fuzz(
+            things['time'], max_endtime, containers['time'], containers['endtime'],
+            self.max_windows, fuzzes)
+        # Empty until the first things are added
+        self.windows = np.zeros((len(containers), 2), dtype=np.int64)
+        self.windows[:, 0] = len(things)
+
+    def grow(self, fuzz_i) -> np.ndarray:
+        """
+        Add the things that touch at the fuzz_i-th matching_fuzz (but not
+        at the previous one), return the indices of the changed windows
+        """
+        start, stop = self.fuzz_bounds[fuzz_i], self.fuzz_bounds[fuzz_i + 1]
+        changed = np.zeros(len(self.windows), dtype=np.bool_)
+        _grow_windows(self.windows, self.container_i[start:stop], self.thing_i[start:stop],
+                      changed)
+        return np.flatnonzero(changed)
+
+
+@numba.njit(nogil=True, cache=True)
+def _pairs_by_first_fuzz(thing_time, thing_max_endtime, container_time, container_endtime,
+                         windows, fuzzes):
+    """
+    Get all the things in the windows of the containers, sorted by the
+    index of the first of the (sorted) fuzzes at which they touch the
+    container. The pairs of the fuzz_i-th fuzz are
+    fuzz_bounds[fuzz_i]:fuzz_bounds[fuzz_i + 1].
+    """
+    n_pairs = 0
+    for container_i in range(len(windows)):
+        n_pairs += max(windows[container_i, 1] - windows[container_i, 0], 0)
+    first_fuzz_i = np.zeros(n_pairs, dtype=np.int64)
+    fuzz_bounds = np.zeros(len(fuzzes) + 2, dtype=np.int64)
+    pair_i = 0
+    for container_i in range(len(windows)):
+        for thing_i in range(windows[container_i, 0], windows[container_i, 1]):
+            # They touch at a matching_fuzz larger than the gap between them
+            gap = max(container_time[container_i] - thing_max_endtime[thing_i],
+                      thing_time[thing_i] - container_endtime[container_i])
+            first_fuzz_i[pair_i] = np.searchsorted(fuzzes, gap, side='right')
+            fuzz_bounds[first_fuzz_i[pair_i] + 2] += 1
+            pair_i += 1
+
+    # Sort the pairs by first_fuzz_i, keep the order of the containers
+    fuzz_bounds = np.cumsum(fuzz_bounds)
+    pair_container_i = np.zeros(n_pairs, dtype=np.int64)
+    pair_thing_i = np.zeros(n_pairs, dtype=np.int64)
+    pair_i = 0
+    for container_i in range(len(windows)):
+        for thing_i in range(windows[container_i, 0], windows[container_i, 1]):
+            sorted_i = fuzz_bounds[first_fuzz_i[pair_i] + 1]
+            fuzz_bounds[first_fuzz_i[pair_i] + 1] += 1
+            pair_container_i[sorted_i] = container_i
+            pair_thing_i[sorted_i] = thing_i
+            pair_i += 1
+    return pair_container_i, pair_thing_i, fuzz_bounds[:-1]
+
+
+@numba.njit(nogil=True, cache=True)
+def _grow_windows(windows, container_i, thing_i, changed):
+    """Extend the windows of the containers to include the things"""
+    for pair_i in range(len(container_i)):
+        window = windows[container_i[pair_i]]
+        window[0] = min(window[0], thing_i[pair_i])
+        window[1] = max(window[1], thing_i[pair_i] + 1)
+        changed[container_i[pair_i]] = True
+
+
+@numba.njit(nogil=True, cache=True)
+def _fuzz_clusters(windows, reverse_windows):
+    """
+    Group the windows at the largest matching_fuzz into clusters that
+    set the outcomes of separate ranges of peaks1 and peaks2, also at
+    any smaller matching_fuzz. Matching a window sets the peaks1 in the
+    window and the peaks2 in the reverse window of one of these peaks1.
+
+    :return: the cluster of each window (-1 if it does not set any
+        peaks), the l1, r1, l2, r2 of the peaks1 and peaks2 of each
+        cluster
+    """
+    cluster = np.full(len(windows), -1, dtype=np.int64)
+    ranges = np.zeros((len(windows), 4), dtype=np.int64)
+    n_clusters = 0
+    max_r1 = max_r2 = 0
+    for window_i in range(len(windows)):
+        l1, r1 = windows[window_i]
+        l2, r2 = np.iinfo(np.int64).max, 0
+        for peak1_i in range(l1, r1):
+            if reverse_windows[peak1_i, 1] > reverse_windows[peak1_i, 0]:
+                l2 = min(l2, reverse_windows[peak1_i, 0])
+                r2 = max(r2, reverse_windows[peak1_i, 1])
+        if r2 <= l2:
+            continue
+        if n_clusters == 0 or (l1 >= max_r1 and l2 >= max_r2):
+            ranges[n_clusters, 0] = l1
+            ranges[n_clusters, 1] = r1
+            ranges[n_clusters, 2] = l2
+            ranges[n_clusters, 3] = r2
+            n_clusters += 1
+        else:
+            ranges[n_clusters - 1, 1] = max(ranges[n_clusters - 1, 1], r1)
+            ranges[n_clusters - 1, 2] = min(ranges[n_clusters - 1, 2], l2)
+            ranges[n_clusters - 1, 3] = max(ranges[n_clusters - 1, 3], r2)
+        cluster[window_i] = n_clusters - 1
+        max_r1 = max(max_r1, r1)
+        max_r2 = max(max_r2, r2)
+    return cluster, ranges[:n_clusters]
+
+
+@numba.njit(nogil=True, cache=True)
+def _reset_clusters(allpeaks1, allpeaks2, cluster_ranges):
+    """Set the peaks of the clusters to not matched"""
+    for l1, r1, l2, r2 in cluster_ranges:
+        allpeaks1['outcome'][l1:r1] = OUTCOME_MISSED
+        allpeaks1['matched_to'][l1:r1] = INT_NAN
+        allpeaks2['outcome'][l2:r2] = OUTCOME_MISSED
+        allpeaks2['matched_to'][l2:r2] = INT_NAN
+
+
+@export
+class FragmentTable:
+    """
+    All peaks2 that overlap with each of peaks1 in CSR format: the
+    fragments of peaks1[i] are fragment_id[offsets[i]:offsets[i + 1]].
+    Contrary to matched_to, which is only the largest fragment, this
+    holds all fragments of split (or chopped, ...) peaks.
+    """
+    __slots__ = ('offsets', 'fragment_id', 'overlap_fraction')
+
+    def __init__(self, offsets, fragment_id, overlap_fraction):
+        self.offsets = offsets
+        self.fragment_id = fragment_id
+        self.overlap_fraction = overlap_fraction
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return f'FragmentTable({len(self)} peaks1, {len(self.fragment_id)} fragments)'
+
+
+@export
+def fragment_table(columns1, columns2, matching_fuzz=0, min_fragments=2) -> FragmentTable:
+    """
+    Get all the peaks2 that overlap with each of peaks1 (within
+    matching_fuzz) and the fraction of the peak1 they overlap with.
+
+    :param columns1: dict of arrays (or array) with time, endtime and id
+        of peaks1, e.g. the truth
+    :param columns2: same for peaks2, e.g. the peaks
+    :param min_fragments: only store the fragments of peaks1 that
+        overlap with at least this many peaks2, for the others the
+        offsets give zero fragments
+    :return: FragmentTable with one row for each of peaks1
+    """
+    time1, endtime1 = _time_and_endtime(columns1)
+    time2, endtime2 = _time_and_endtime(columns2)
+    # Peaks2 in the window of each peak1 (the reverse windows of matching)
+    windows = strax.processing.general._touching_windows(
+        time2, endtime2, time1, endtime1, window=matching_fuzz).astype(np.int64)
+    offsets, fragment_i, overlap_fraction = _fragment_table(
+        time1, endtime1, time2, endtime2, windows, matching_fuzz, min_fragments)
+    return FragmentTable(offsets, np.asarray(columns2['id'])[fragment_i], overlap_fraction)
+
+
+def _time_and_endtime(columns):
+    """Time and endtime as int64 arrays from a dict of arrays or an array"""
+    if hasattr(columns, 'dtype') and 'endtime' not in columns.dtype.names:
+        endtime = strax.endtime(columns)
     else:
-        windows = strax.touching_windows(allpeaks1, allpeaks2, window=matching_fuzz)
+        endtime = columns['endtime']
+    return (np.asarray(columns['time'], dtype=np.int64),
+            np.asarray(endtime, dtype=np.int64))
+
+
+@numba.njit(nogil=True, cache=True)
+def _fragment_table(time1, endtime1, time2, endtime2, windows, matching_fuzz, min_fragments):
+    """Count the fragments of each peak, then fill them in"""
+    n_fragments = np.zeros(len(time1), dtype=np.int64)
+    for i1 in range(len(time1)):
+        l2, r2 = windows[i1]
+        n = 0
+        for i2 in range(l2, r2):
+            # Peaks2 may overlap with each other, check each of them
+            if (time2[i2] < endtime1[i1] + matching_fuzz and
+                    endtime2[i2] > time1[i1] - matching_fuzz):
+                n += 1
+        if n >= min_fragments:
+            n_fragments[i1] = n
+
+    offsets = np.zeros(len(time1) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(n_fragments)
+    fragment_i = np.zeros(offsets[-1], dtype=np.int64)
+    overlap_fraction = np.zeros(offsets[-1], dtype=np.float32)
+    for i1 in range(len(time1)):
+        if not n_fragments[i1]:
+            continue
+        length = endtime1[i1] - time1[i1]
+        j = offsets[i1]
+        l2, r2 = windows[i1]
+        for i2 in range(l2, r2):
+            if (time2[i2] < endtime1[i1] + matching_fuzz and
+                    endtime2[i2] > time1[i1] - matching_fuzz):
+                fragment_i[j] = i2
+                if length > 0:
+                    overlap = min(endtime1[i1], endtime2[i2]) - max(time1[i1], time2[i2])
+                    overlap_fraction[j] = max(overlap, 0) / length
+                j += 1
+    return offsets, fragment_i, overlap_fraction
+
+
+# Quality of the match of a peak to the peak it is matched to, see pair_metrics
+PAIR_METRICS_DTYPE = np.dtype([
+    ('overlap_fraction', np.float32),
+    ('start_offset', np.int64),
+    ('end_offset', np.int64),
+    ('center_offset', np.float64),
+])
+
+
+@export
+def pair_metrics(columns1, columns2, matched_to1) -> np.ndarray:
+    """
+    Compare each of peaks1 to the peak in peaks2 it is matched to. For
+    peaks1 that are not matched, the offsets are INT_NAN (or NaN).
+
+    :param columns1: dict of arrays (or array) with time, endtime and id
+        of peaks1 and optionally center_time, e.g. for the truth
+        dict(center_time=truth['t_mean_photon'], ...)
+    :param columns2: same for peaks2
+    :param matched_to1: id in peaks2 of the peak each of peaks1 is
+        matched to (see match_peak_columns)
+    :return: array of PAIR_METRICS_DTYPE with for each of peaks1 the
+        fraction of peaks1 that overlaps with its match and the
+        start, end and center time of the match minus that of peaks1
+    """
+    time1, endtime1 = _time_and_endtime(columns1)
+    time2, endtime2 = _time_and_endtime(columns2)
+    center1, center2 = [np.asarray(_get_center_time(columns, time, endtime), dtype=np.float64)
+                        for columns, time, endtime in ((columns1, time1, endtime1),
+                                                       (columns2, time2, endtime2))]
+
+    # Index of the matched peak, ids are usually sorted already
+    ids2 = np.asarray(columns2['id'])
+    order = (np.argsort(ids2, kind='stable') if np.any(np.diff(ids2) < 0)
+             else np.arange(len(ids2)))
+    matched_to1 = np.asarray(matched_to1)
+    index = np.searchsorted(ids2[order], matched_to1).clip(0, max(len(ids2) - 1, 0))
+    matched_i = np.full(len(matched_to1), -1, dtype=np.int64)
+    if len(ids2):
+        is_matched = (matched_to1 != INT_NAN) & (ids2[order][index] == matched_to1)
+        matched_i[is_matched] = order[index[is_matched]]
+
+    res = np.zeros(len(time1), dtype=PAIR_METRICS_DTYPE)
+    _pair_metrics(time1, endtime1, center1, time2, endtime2, center2, matched_i, res)
+    return res
+
+
+def _get_center_time(columns, time, endtime):
+    """Center time of the peaks, the middle of the peak if not given"""
+    names = columns.dtype.names if hasattr(columns, 'dtype') else tuple(columns.keys())
+    if 'center_time' in names:
+        return columns['center_time']
+    return (time + endtime) / 2
+
+
+@numba.njit(nogil=True, cache=True)
+def _pair_metrics(time1, endtime1, center1, time2, endtime2, center2, matched_i, res):
+    for i1 in range(len(time1)):
+        i2 = matched_i[i1]
+        if i2 < 0:
+            res[i1]['overlap_fraction'] = np.nan
+            res[i1]['start_offset'] = INT_NAN
+            res[i1]['end_offset'] = INT_NAN
+            res[i1]['center_offset'] = np.nan
+            continue
+        length = endtime1[i1] - time1[i1]
+        overlap = min(endtime1[i1], endtime2[i2]) - max(time1[i1], time2[i2])
+        res[i1]['overlap_fraction'] = max(overlap, 0) / length if length > 0 else np.nan
+        res[i1]['start_offset'] = time2[i2] - time1[i1]
+        res[i1]['end_offset'] = endtime2[i2] - endtime1[i1]
+        res[i1]['center_offset'] = center2[i2] - center1[i1]
+
+
+def _match_in_place(allpeaks1, allpeaks2, matching_fuzz, unknown_types, engine, n_threads,
+                    checked=(False, False)):
+    """
+    Set the outcome and matched_to fields of allpeaks1 and allpeaks2,
+    both should be arrays of MATCH_DTYPE (see _gather_match_columns)
+    """
+    _check_before_matching(allpeaks1, allpeaks2, checked)
+
+    log.debug('Getting windows')
+    # We did the checks of strax.touching_windows already
+    windows = strax.processing.general._touching_windows(
+        allpeaks1['time'], allpeaks1['endtime'],
+        allpeaks2['time'], allpeaks2['endtime'],
+        window=matching_fuzz).astype(np.int64)
+
+    # make array for numba
+    unknown_types = np.array(unknown_types)
+
+    if engine == 'sweep':
+        # The deep window of each window is the reverse window of the
+        # first peak in allpeaks1 of that window, get them all at once.
+        reverse_windows = strax.processing.general._touching_windows(
+            allpeaks2['time'], allpeaks2['endtime'],
+            allpeaks1['time'], allpeaks1['endtime'],
+            window=matching_fuzz).astype(np.int64)
+        if n_threads > 1 and len(windows) and len(allpeaks1):
+            deep_windows = reverse_windows[np.clip(windows[:, 0], 0, len(allpeaks1) - 1)]
+            _match_threaded(
+                lambda start, stop: _match_peaks_sweep(
+                    allpeaks1, allpeaks2, windows[start:stop], reverse_windows, unknown_types),
+                windows, deep_windows, n_threads)
+        else:
+            _match_peaks_sweep(allpeaks1, allpeaks2, windows, reverse_windows, unknown_types)
+        return
 
     deep_windows = np.empty((0, 2), dtype=(np.int64, np.int64))
     # Each of the windows projects to a set of peaks in allpeaks2
@@ -105,12 +780,171 @@ def match_peaks(allpeaks1,
     assert np.shape(np.shape(deep_windows))[0] == 2, (
         f'deep_windows shape is wrong {np.shape(deep_windows)}\n{deep_windows}')
 
-    # make array for numba
-    unknown_types = np.array(unknown_types)
-
     # Inner matching
-    _match_peaks(allpeaks1, allpeaks2, windows, deep_windows, unknown_types)
-    return allpeaks1, allpeaks2
+    if n_threads > 1 and len(windows):
+        _match_threaded(
+            lambda start, stop: _match_peaks(
+                allpeaks1, allpeaks2, windows[start:stop], deep_windows[start:stop], unknown_types),
+            windows, deep_windows, n_threads)
+    else:
+        _match_peaks(allpeaks1, allpeaks2, windows, deep_windows, unknown_types)
+
+
+@export
+def match_many(pairs, max_workers=None, **kwargs) -> list:
+    """
+    Perform peak matching (see match_peaks) for many pairs of
+    (allpeaks1, allpeaks2), e.g. the truth and peaks of many runs. The
+    pairs are matched concurrently in a thread pool, the matching
+    kernels release the GIL.
+
+    :param pairs: iterable of (allpeaks1, allpeaks2)
+    :param max_workers: number of threads, see ThreadPoolExecutor
+    :param kwargs: passed to match_peaks
+    :return: list of the results of match_peaks in the order of pairs
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(match_peaks, allpeaks1, allpeaks2, **kwargs)
+                   for allpeaks1, allpeaks2 in pairs]
+        return [f.result() for f in futures]
+
+
+@export
+def iter_match_peaks(peaks1_chunks,
+                     peaks2_chunks,
+                     matching_fuzz=0,
+                     **kwargs):
+    """
+    Perform peak matching (see match_peaks) on two iterables of
+    time-ordered chunks (numpy arrays or strax.Chunks, e.g. from
+    st.get_iter). Only the peaks that cannot overlap with peaks in
+    later chunks are matched, the others are carried over to the next
+    chunk. This limits the memory to the size of the chunks rather
+    than the size of the run.
+
+    Yields (peaks1, peaks2) of the matched peaks with the outcome and
+    matched_to fields, together these are the same as the result of
+    match_peaks on the concatenated chunks.
+    :param kwargs: passed to match_peaks
+    """
+    iters = [iter(peaks1_chunks), iter(peaks2_chunks)]
+    buffers = [None, None]
+    # Start of the next peak in each list may not be before this
+    seen_until = [-float('inf'), -float('inf')]
+    exhausted = [False, False]
+
+    def load(i):
+        try:
+            chunk = next(iters[i])
+        except StopIteration:
+            exhausted[i] = True
+            return
+        data = chunk.data if isinstance(chunk, strax.Chunk) else chunk
+        if len(data) and data['time'][0] < seen_until[i]:
+            raise ValueError('Chunks are not sorted by time')
+        if buffers[i] is None or not len(buffers[i]):
+            buffers[i] = data
+        elif len(data):
+            buffers[i] = np.concatenate([buffers[i], data])
+        if len(data):
+            seen_until[i] = data['time'][-1]
+
+    load(0)
+    load(1)
+    while True:
+        for i in (0, 1):
+            if exhausted[i] and buffers[i] is None and buffers[1 - i] is not None:
+                # There are no chunks at all, use an empty array like the other list
+                buffers[i] = buffers[1 - i][:0]
+        if all(exhausted):
+            frontier = float('inf')
+        else:
+            # Peaks in allpeaks1 reach matching_fuzz further out
+            frontier = min(seen_until[0] - matching_fuzz if not exhausted[0] else float('inf'),
+                           seen_until[1] if not exhausted[1] else float('inf'))
+        if buffers[0] is not None and buffers[1] is not None:
+            split = _finalized_until(buffers[0], buffers[1], matching_fuzz, frontier)
+            if split[0] or split[1]:
+                yield match_peaks(buffers[0][:split[0]],
+                                  buffers[1][:split[1]],
+                                  matching_fuzz=matching_fuzz,
+                                  **kwargs)
+                buffers = [buffers[0][split[0]:], buffers[1][split[1]:]]
+        if all(exhausted):
+            return
+        # Load the list that is behind (unless it is done)
+        behind = int(seen_until[1] < seen_until[0] - matching_fuzz)
+        if exhausted[behind]:
+            behind = 1 - behind
+        load(behind)
+
+
+def _finalized_until(peaks1, peaks2, matching_fuzz, frontier):
+    """
+    Get the number of peaks in peaks1 and peaks2 that do not overlap
+    with the other peaks or with peaks starting after the frontier
+    """
+    # Peaks match if they are closer than matching_fuzz, extend peaks1
+    starts = np.concatenate([peaks1['time'] - matching_fuzz, peaks2['time']])
+    ends = np.concatenate([strax.endtime(peaks1) + matching_fuzz, strax.endtime(peaks2)])
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    # We can cut at the start of a peak if none of the earlier peaks
+    # extends beyond it, or after all the peaks if they end in time.
+    max_end = np.maximum.accumulate(ends)
+    can_cut = np.concatenate([[True], max_end[:-1] <= starts[1:]]) & (starts <= frontier)
+    if len(ends) and max_end[-1] <= frontier:
+        cut = float('inf')
+    elif np.any(can_cut):
+        cut = starts[np.where(can_cut)[0][-1]]
+    else:
+        return 0, 0
+    return (np.searchsorted(peaks1['time'] - matching_fuzz, cut, side='left'),
+            np.searchsorted(peaks2['time'], cut, side='left'))
+
+
+def _match_threaded(match_windows, windows, deep_windows, n_threads):
+    """
+    Split the windows into n_threads groups of independent clusters
+    and call match_windows(start, stop) for each of them in a thread.
+    The matching kernels release the GIL.
+    """
+    cluster_starts = _cluster_starts(windows, deep_windows)
+    # Balance the groups by the number of peaks in the windows
+    work = np.cumsum(np.diff(windows, axis=1)[:, 0].clip(0) +
+                     np.diff(deep_windows, axis=1)[:, 0].clip(0))
+    work_before_cluster = np.concatenate([[0], work])[cluster_starts]
+    targets = work[-1] * np.arange(1, n_threads) / n_threads
+    split_at = cluster_starts[np.searchsorted(work_before_cluster, targets).clip(
+        0, len(cluster_starts) - 1)]
+    bounds = np.unique(np.concatenate([[0], split_at, [len(windows)]]))
+    log.debug(f'Matching {len(cluster_starts)} clusters in {len(bounds) - 1} threads')
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = [executor.submit(match_windows, start, stop)
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+        for f in futures:
+            f.result()
+
+
+@numba.njit(nogil=True, cache=True)
+def _cluster_starts(windows, deep_windows):
+    """
+    Get the indices of the windows that start a new cluster, i.e. none
+    of the peaks in the window (or deep window) are in an earlier window
+    """
+    is_start = np.zeros(len(windows), dtype=np.bool_)
+    is_start[0] = True
+    max_r1 = max_r2 = 0
+    for window_i in range(len(windows)):
+        l1, r1 = windows[window_i]
+        if r1 <= l1:
+            continue
+        l2, r2 = deep_windows[window_i]
+        if l1 >= max_r1 and l2 >= max_r2:
+            is_start[window_i] = True
+        max_r1 = max(max_r1, r1)
+        max_r2 = max(max_r2, r2)
+    return np.where(is_start)[0]
 
 
 @numba.jit(nopython=True, nogil=True, cache=True)
@@ -134,23 +968,9 @@ def _match_peaks(allpeaks1, allpeaks2, windows, deep_windows, unknown_types):
             elif len(matching_peaks) == 1:
                 # A unique match! Hurray!
                 p2 = matching_peaks[0]
-                p1['matched_to'] = p2['id']
-                p2['matched_to'] = p1['id']
-                # Do the types match?
-                if p1['type'] == p2['type']:
-                    p1['outcome'] = 'found'
-                    p2['outcome'] = 'found'
-                else:
-                    if _in(p1['type'], unknown_types):
-                        p2['outcome'] = 'unclassified'
-                    else:
-                        p2['outcome'] = 'misid_as_s' + str(p1['type'])
-                    if _in(p2['type'], unknown_types):
-                        p1['outcome'] = 'unclassified'
-                    else:
-                        p1['outcome'] = 'misid_as_s' + str(p2['type'])
-                    # If the peaks are unknown in both sets, they will
-                    # count as 'found'.
+                # If the peaks are unknown in both sets, they will
+                # count as 'found'.
+                _set_unique_match(p1, p2, unknown_types)
                 matching_peaks[0] = p2
             else:
                 # More than one peak overlaps p1
@@ -183,7 +1003,93 @@ def _match_peaks(allpeaks1, allpeaks2, windows, deep_windows, unknown_types):
                 peaks_1[i_in_peaks_1] = matching_peaks[i_in_matching_peaks]
 
 
-@numba.jit(nopython=True)
+@numba.njit(nogil=True, cache=True)
+def _match_peaks_sweep(allpeaks1, allpeaks2, windows, reverse_windows, unknown_types):
+    """
+    Same matching as _match_peaks but without copying the matching
+    peaks. For each window only the last peak of allpeaks1 determines
+    the final state of the fragments in allpeaks2, so we only need to
+    do the full merge once per window. The other peaks only need the
+    number of fragments of each type.
+    """
+    for l1, r1 in windows:
+        if r1 <= l1:
+            continue
+        l2, r2 = reverse_windows[l1]
+        n_2 = r2 - l2
+        if n_2 <= 0:
+            continue
+
+        if n_2 == 1:
+            for i1 in range(l1, r1):
+                _set_unique_match(allpeaks1[i1], allpeaks2[l2], unknown_types)
+            matched_i2 = l2
+        else:
+            fragment_types = allpeaks2['type'][l2:r2]
+            type_min = fragment_types.min()
+            type_counts = np.zeros(fragment_types.max() - type_min + 1, dtype=np.int64)
+            n_unknown = 0
+            for t in fragment_types:
+                type_counts[t - type_min] += 1
+                if _in(t, unknown_types):
+                    n_unknown += 1
+            matched_i2 = l2 + _argmax(allpeaks2['area'][l2:r2])
+            for i1 in range(l1, r1 - 1):
+                parent = allpeaks1[i1]
+                parent_type = parent['type']
+                n_ok = 0
+                if 0 <= parent_type - type_min < len(type_counts):
+                    n_ok = type_counts[parent_type - type_min]
+                n_ok_or_unknown = n_ok + n_unknown
+                if _in(parent_type, unknown_types):
+                    n_ok_or_unknown -= n_ok
+                parent['outcome'] = _split_outcome(n_ok, n_unknown, n_ok_or_unknown, n_2)
+                parent['matched_to'] = allpeaks2[matched_i2]['id']
+            # The last parent sets the final state of the fragments
+            handle_peak_merge(parent=allpeaks1[r1 - 1],
+                              fragments=allpeaks2[l2:r2],
+                              unknown_types=unknown_types)
+
+        # Match in reverse, all the peaks in this window are matched
+        # to the same peak, if there are several, it is merged.
+        if r1 - l1 > 1:
+            handle_peak_merge(parent=allpeaks2[matched_i2],
+                              fragments=allpeaks1[l1:r1],
+                              unknown_types=unknown_types)
+
+
+@numba.njit(nogil=True, cache=True)
+def _set_unique_match(p1, p2, unknown_types):
+    """Set the outcome of two peaks that are uniquely matched"""
+    p1['matched_to'] = p2['id']
+    p2['matched_to'] = p1['id']
+    if p1['type'] == p2['type']:
+        p1['outcome'] = OUTCOME_FOUND
+        p2['outcome'] = OUTCOME_FOUND
+    else:
+        if _in(p1['type'], unknown_types):
+            p2['outcome'] = OUTCOME_UNCLASSIFIED
+        else:
+            p2['outcome'] = MISID_AS_OFFSET + p1['type']
+        if _in(p2['type'], unknown_types):
+            p1['outcome'] = OUTCOME_UNCLASSIFIED
+        else:
+            p1['outcome'] = MISID_AS_OFFSET + p2['type']
+
+
+@numba.njit(nogil=True, cache=True)
+def _split_outcome(n_ok, n_unknown, n_ok_or_unknown, n_fragments):
+    """Outcome of a parent peak, see handle_peak_merge"""
+    if n_ok_or_unknown < n_fragments:
+        return OUTCOME_SPLIT_AND_MISID
+    if n_ok > 1:
+        return OUTCOME_SPLIT
+    if n_unknown == n_fragments:
+        return OUTCOME_SPLIT_AND_UNCLASSIFIED
+    return OUTCOME_CHOPPED
+
+
+@numba.njit(nogil=True, cache=True)
 def handle_peak_merge(parent, fragments, unknown_types):
     found_types = fragments['type']
     is_ok = found_types == parent['type']
@@ -193,31 +1099,31 @@ def handle_peak_merge(parent, fragments, unknown_types):
     for i in range(len(fragments)):
         if is_unknown[i] or is_misclass[i]:
             if _in(parent['type'], unknown_types):
-                fragments[i]['outcome'] = 'merged_to_unknown'
+                fragments[i]['outcome'] = OUTCOME_MERGED_TO_UNKNOWN
             else:
-                fragments[i]['outcome'] = 'merged_to_s' + str(parent['type'])
+                fragments[i]['outcome'] = MERGED_TO_OFFSET + parent['type']
         else:
-            fragments[i]['outcome'] = 'merged'
+            fragments[i]['outcome'] = OUTCOME_MERGED
         # Link the fragments to the parent
         fragments[i]['matched_to'] = parent['id']
     if np.any(is_misclass):
-        parent['outcome'] = 'split_and_misid'
+        parent['outcome'] = OUTCOME_SPLIT_AND_MISID
     # All fragments are either ok or unknown. If more than one fragment
     # is given the same class as the parent peak, then call it "split".
     elif len(np.where(is_ok)[0]) > 1:
-        parent['outcome'] = 'split'
+        parent['outcome'] = OUTCOME_SPLIT
     elif np.all(is_unknown):
-        parent['outcome'] = 'split_and_unclassified'
+        parent['outcome'] = OUTCOME_SPLIT_AND_UNCLASSIFIED
     # If exactly one fragment out of > 1 fragments is correctly
     # classified, then call the parent chopped
     else:
-        parent['outcome'] = 'chopped'
+        parent['outcome'] = OUTCOME_CHOPPED
     # We can't link the parent to all fragments. Link to the largest one
     _max_idx = _argmax(fragments['area'])
     parent['matched_to'] = fragments[_max_idx]['id']
 
 
-@numba.jit(cache=True)
+@numba.njit(nogil=True, cache=True)
 def get_deepwindows(windows, peaks_a, peaks_b, matching_fuzz):
     """Get matching window of the matched peak versus the original peak"""
     n_windows = len(windows)
@@ -282,7 +1188,7 @@ def append_fields(base, names, data, dtypes=None, fill_value=-1,
 
 
 # --- Numba functions where numpy does not suffice ---
-@numba.njit
+@numba.njit(nogil=True, cache=True)
 def _in1d(arr1, arr2):
     """
     Copy np.in1d logic for numba
@@ -297,7 +1203,7 @@ def _in1d(arr1, arr2):
     return res
 
 
-@numba.jit(nopython=True)
+@numba.njit(nogil=True, cache=True)
 def _in(val, arr):
     """
     Check if val is in array
@@ -309,7 +1215,7 @@ def _in(val, arr):
     return False
 
 
-@numba.jit(nopython=True)
+@numba.njit(nogil=True, cache=True)
 def _argmax(arr):
     """
     Get index of max argument (np.argmax)
@@ -325,13 +1231,13 @@ def _argmax(arr):
     return i
 
 
-@numba.njit
+@numba.njit(nogil=True, cache=True)
 def _combine_and_flip(arr1, arr2):
     """Combine the flipped arrays"""
     return _bool_flip(arr1).astype(np.bool_) & _bool_flip(arr2.astype(np.bool_))
 
 
-@numba.njit
+@numba.njit(nogil=True, cache=True)
 def _bool_flip(arr):
     """Use True ^ array"""
     res = np.zeros(len(arr), dtype=np.bool_)
@@ -8,6 +8,7 @@ import multihist
 from scipy.stats import norm
 from immutabledict import immutabledict
 from copy import deepcopy
+from .matching import outcome_label, OUTCOME_FOUND
 
 export, __all__ = strax.exporter()
 
@@ -55,7 +56,7 @@ def peak_matching_histogram(results, histogram_key, bin_edges):
         # Histogram the # of peaks that have this outcome
         hist = Hist1d(results[results['outcome'] == outcome][histogram_key],
                       bins=n_peaks_hist.bin_edges)
-        hists[outcome] = hist
+        hists[outcome_label(outcome)] = hist
 
     return hists
 
@@ -297,7 +298,7 @@ def rec_diff(def_data,
     axes = iter(axes.flatten())
     for axi, dat in enumerate(data_sets):
         plt.sca(next(axes))
-        mask = (dat['type'] == 1) & (dat['outcome'] == 'found')
+        mask = (dat['type'] == 1) & (dat['outcome'] == OUTCOME_FOUND)
         _rec_diff_inner(dat[mask],
                         title=f'{data_set_names[axi]} S1 rec. bias',
                         **s1_kwargs)
@@ -305,7 +306,7 @@ def rec_diff(def_data,
             plt.legend()
     for axi, dat in enumerate(data_sets):
         plt.sca(next(axes))
-        mask = (dat['type'] == 2) & (dat['outcome'] == 'found')
+        mask = (dat['type'] == 2) & (dat['outcome'] == OUTCOME_FOUND)
         _rec_diff_inner(dat[mask],
                         title=f'{data_set_names[axi]} S2 rec. bias',
                         **s2_kwargs)
@@ -0,0 +1,61 @@
+"""
+Compile the numba kernels of pema ahead of processing. The kernels are
+cached (see numba's NUMBA_CACHE_DIR) so that later jobs can load them
+instead of compiling them again.
+"""
+import logging
+import threading
+
+import numba
+import numpy as np
+import strax
+
+export, __all__ = strax.exporter()
+
+log = logging.getLogger('Pema warmup')
+
+
+@export
+def precompile() -> None:
+    """
+    Compile the numba kernels for the dtypes used by MatchPeaks. If
+    NUMBA_CACHE_DIR is set (before pema is imported), the compiled
+    kernels are stored there.
+    """
+    # Import here to prevent circular imports
+    from . import matching
+    log.info(f'Compiling pema kernels, caching to {numba.config.CACHE_DIR or "__pycache__"}')
+
+    columns = dict(time=np.array([0, 5, 20], dtype=np.int64),
+                   endtime=np.array([10, 15, 30], dtype=np.int64),
+                   id=np.arange(3, dtype=np.int64),
+                   type=np.array([1, 2, 2], dtype=np.int16),
+                   area=np.ones(3, dtype=np.float64))
+    matching.preflight_peaks(columns['time'], columns['endtime'], columns['id'])
+    matching.fragment_table(columns, columns)
+    matching.pair_metrics(columns, columns, columns['id'])
+
+    # The plugins pass (strided) fields of structured arrays, numba
+    # compiles these separately from contiguous arrays
+    truth = np.zeros(3, dtype=[(name, column.dtype) for name, column in columns.items()] +
+                     [('center_time', np.float64)])
+    for name, column in columns.items():
+        truth[name] = column
+    truth['center_time'] = (truth['time'] + truth['endtime']) / 2
+    peaks = truth[list(columns)]
+    matching.preflight_peaks(truth['time'], truth['endtime'], truth['id'])
+    matching.preflight_peaks(peaks['time'], peaks['endtime'])
+    matching.fragment_table(truth, peaks)
+    matching.pair_metrics(truth, peaks, truth['id'])
+    for engine in ('windows', 'sweep'):
+        for n_threads in (1, 2):
+            matching.match_peak_columns(columns, columns, engine=engine, n_threads=n_threads)
+    log.info('Compiled pema kernels')
+
+
+@export
+def precompile_in_background() -> threading.Thread:
+    """Run precompile in a daemon thread, join the thread to wait for it"""
+    thread = threading.Thread(target=precompile, name='pema_precompile', daemon=True)
+    thread.start()
+    return thread
@@ -1,3 +1,7 @@
+import collections
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 import wfsim
@@ -10,6 +14,24 @@ from warnings import warn
 
 export, __all__ = strax.exporter()
 
+# Our XENON-like detector for NEST
+NUCLEUS_A = 131.293
+NUCLEUS_Z = 54.
+LXE_DENSITY = 2.862  # g/cm^3   #SR1 Value
+
+# Yield tables are cached here by default (per user), see get_yield_table
+YIELD_TABLE_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'pema', 'yield_tables')
+
+# Kr83m decays in a cascade of 32.1 keV and 9.4 keV, the intermediate
+# state has a half life of 154.4 ns, see kr83_instructions
+KR83M_NEST_ID = 11
+KR83M_ENERGIES = (32.1, 9.4)  # keV
+KR83M_HALF_LIFE = 154.4  # ns
+# The last delay bin of the Kr83m yield tables ends at this many mean lives
+KR83M_MAX_LIVES = 20
+
 
 @export
 def rand_instructions(
@@ -21,6 +43,11 @@ def rand_instructions(
         tpc_length: float = straxen.tpc_z,
         tpc_radius: float = straxen.tpc_r,
         nest_inst_types: ty.Union[ty.List[int], ty.Tuple[ty.List], np.ndarray, None] = None,
+        use_yield_tables: bool = False,
+        yield_table_cache: ty.Optional[str] = YIELD_TABLE_CACHE,
+        seed: ty.Optional[int] = None,
+        n_workers: int = 1,
+        block_size: int = 10_000,
 ) -> dict:
     """
     Generate instructions to run WFSim
@@ -32,72 +59,455 @@ def rand_instructions(
     :param tpc_radius: the max radius of the detector
     :param nest_inst_types: the
     :param drift_field:
+    :param use_yield_tables: sample the quanta from yield tables (see
+        get_yield_table) for all events at once instead of calling NEST
+        for each event. Much faster for many events, the quanta follow
+        the same mean and (co)variance but not the exact NEST shapes.
+    :param yield_table_cache: directory to cache the yield tables, None
+        for no caching (see get_yield_table)
+    :param seed: seed of the random generators. If None, the seed is
+        drawn from np.random so that np.random.seed still applies.
+    :param n_workers: generate the blocks of events in this many
+        processes. The instructions only depend on the seed, not on
+        n_workers.
+    :param block_size: number of events of each block, each block has
+        its own random generator (spawned from the seed)
     :return:
     """
+    n_events = event_rate * chunk_size * n_chunk
+    inst = np.zeros(2 * n_events, dtype=wfsim.instruction_dtype)
+    inst[:] = -1
+    for start, stop, events in _iter_event_blocks(
+            n_events, seed, n_workers, block_size,
+            _block_kwargs(drift_field, energy_range, tpc_length, tpc_radius,
+                          nest_inst_types, use_yield_tables, yield_table_cache)):
+        _fill_instructions(inst[2 * start:2 * stop], events, start, n_events,
+                           chunk_size, n_chunk, drift_field)
+    _warn_not_filled(inst)
+    return inst
+
+
+@export
+def iter_rand_instructions(
+        event_rate: int,
+        chunk_size: int,
+        n_chunk: int,
+        drift_field: float,
+        energy_range: ty.Union[tuple, list, np.ndarray],
+        tpc_length: float = straxen.tpc_z,
+        tpc_radius: float = straxen.tpc_r,
+        nest_inst_types: ty.Union[ty.List[int], ty.Tuple[ty.List], np.ndarray, None] = None,
+        use_yield_tables: bool = False,
+        yield_table_cache: ty.Optional[str] = YIELD_TABLE_CACHE,
+        seed: ty.Optional[int] = None,
+        n_workers: int = 1,
+        block_size: int = 10_000,
+) -> ty.Iterator[np.ndarray]:
+    """
+    Same as rand_instructions, but yield the instructions of each chunk
+    (event_number) instead of returning all of them at once, so that
+    the memory does not depend on n_chunk. With the same seed, the
+    chunks together are the same as the result of rand_instructions.
+    For example, write them with pema.inst_to_file(...,
+    get_inst_from=pema.iter_rand_instructions).
+
+    See rand_instructions for the arguments.
+    """
+    n_events = event_rate * chunk_size * n_chunk
+    events_per_chunk = event_rate * chunk_size
+    chunk_i = 0
+    pending = []
+    for start, stop, events in _iter_event_blocks(
+            n_events, seed, n_workers, block_size,
+            _block_kwargs(drift_field, energy_range, tpc_length, tpc_radius,
+                          nest_inst_types, use_yield_tables, yield_table_cache)):
+        block = np.zeros(2 * (stop - start), dtype=wfsim.instruction_dtype)
+        block[:] = -1
+        _fill_instructions(block, events, start, n_events, chunk_size, n_chunk, drift_field)
+
+        # Blocks may end halfway a chunk, or span several chunks
+        block_i = start
+        while block_i < stop:
+            chunk_stop = (chunk_i + 1) * events_per_chunk
+            until = min(stop, chunk_stop)
+            pending.append(block[2 * (block_i - start):2 * (until - start)])
+            block_i = until
+            if block_i == chunk_stop:
+                chunk = np.concatenate(pending)
+                if chunk_i == 0:
+                    _warn_not_filled(chunk)
+                yield chunk
+                pending = []
+                chunk_i += 1
+
+
+def _block_kwargs(drift_field, energy_range, tpc_length, tpc_radius,
+                  nest_inst_types, use_yield_tables, yield_table_cache) -> dict:
+    """Keyword arguments of _rand_events, see rand_instructions"""
     if nest_inst_types is None:
         nest_inst_types = [7]
+    block_kwargs = dict(drift_field=drift_field,
+                        energy_range=energy_range,
+                        tpc_length=tpc_length,
+                        tpc_radius=tpc_radius,
+                        nest_inst_types=nest_inst_types,
+                        yield_tables=None,
+                        )
+    if use_yield_tables:
+        block_kwargs['yield_tables'] = {
+            interaction_type: get_yield_table(interaction_type, drift_field, energy_range,
+                                              cache_dir=yield_table_cache)
+            for interaction_type in np.unique(nest_inst_types)}
+    return block_kwargs
 
-    n_events = event_rate * chunk_size * n_chunk
-    total_time = chunk_size * n_chunk
 
-    inst = np.zeros(2 * n_events, dtype=wfsim.instruction_dtype)
-    inst[:] = -1
+def _iter_event_blocks(n_events, seed, n_workers, block_size, block_kwargs):
+    """
+    Yield start, stop and the positions and quanta of each block of
+    events, in order. With n_workers > 1, the blocks are generated in
+    a process pool, a few blocks ahead of the ones that are yielded.
+    """
+    if seed is None:
+        seed = np.random.randint(np.iinfo(np.int64).max)
+    blocks = np.arange(0, n_events + block_size, block_size).clip(0, n_events)
+    blocks = np.unique(blocks)
+    seeds = np.random.SeedSequence(seed).spawn(len(blocks) - 1)
+    bounds = list(zip(blocks[:-1], blocks[1:]))
+    progress = tqdm(total=len(bounds), desc='generating instructions from nest')
+    if n_workers <= 1:
+        for (start, stop), seed_sequence in zip(bounds, seeds):
+            yield start, stop, _rand_block(seed_sequence, stop - start, block_kwargs)
+            progress.update()
+        progress.close()
+        return
 
-    uniform_times = total_time * (np.arange(n_events) + 0.5) / n_events
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = collections.deque()
+        for (start, stop), seed_sequence in zip(bounds, seeds):
+            futures.append((start, stop, executor.submit(
+                _rand_block, seed_sequence, stop - start, block_kwargs)))
+            if len(futures) > 2 * n_workers:
+                start, stop, future = futures.popleft()
+                yield start, stop, future.result()
+                progress.update()
+        while futures:
+            start, stop, future = futures.popleft()
+            yield start, stop, future.result()
+            progress.update()
+    progress.close()
 
-    inst['time'] = np.repeat(uniform_times, 2) * int(1e9)
-    inst['event_number'] = np.digitize(inst['time'],
-                                       1e9 * np.arange(n_chunk) *
-                                       chunk_size) - 1
-    inst['type'] = np.tile([1, 2], n_events)
 
-    r = np.sqrt(np.random.uniform(0, tpc_radius ** 2, n_events))
-    t = np.random.uniform(-np.pi, np.pi, n_events)
-    inst['x'] = np.repeat(r * np.cos(t), 2)
-    inst['y'] = np.repeat(r * np.sin(t), 2)
-    inst['z'] = np.repeat(np.random.uniform(-tpc_length, 0, n_events), 2)
+def _warn_not_filled(inst):
+    for field in inst.dtype.names:
+        if np.any(inst[field] == -1):
+            warn(f'{field} is not (fully) filled')
+
+
+def _rand_block(seed_sequence, n_events, kwargs):
+    """Generate the positions and quanta of a block of events"""
+    return _rand_events(np.random.default_rng(seed_sequence), n_events, **kwargs)
+
+
+def _rand_events(rng, n_events, drift_field, energy_range, tpc_length, tpc_radius,
+                 nest_inst_types, yield_tables=None) -> dict:
+    """
+    Generate the positions and quanta of n_events events. All random
+    numbers come from the rng (also those of NEST), see rand_instructions
+    """
+    events = dict(**_rand_positions(rng, n_events, tpc_length, tpc_radius),
+                  e_dep=rng.uniform(*energy_range, n_events),
+                  recoil=rng.choice(nest_inst_types, n_events),
+                  photons=np.zeros(n_events, dtype=np.int64),
+                  electrons=np.zeros(n_events, dtype=np.int64),
+                  excitons=np.zeros(n_events, dtype=np.int64),
+                  )
+
+    if yield_tables is not None:
+        for interaction_type, table in yield_tables.items():
+            mask = events['recoil'] == interaction_type
+            events['photons'][mask], events['electrons'][mask], events['excitons'][mask] = (
+                table.sample(events['e_dep'][mask], rng=rng))
+        return events
 
     # Here we'll define our XENON-like detector
     nest_calc = nestpy.NESTcalc(nestpy.VDetector())
-    nucleus_A = 131.293
-    nucleus_Z = 54.
-    lxe_density = 2.862  # g/cm^3   #SR1 Value
-
-    energy = np.random.uniform(*energy_range, n_events)
-    quanta = []
-    exciton = []
-    recoil = []
-    e_dep = []
-    for energy_deposit in tqdm(energy, desc='generating instructions from nest'):
-        interaction_type = np.random.choice(nest_inst_types)
-        interaction = nestpy.INTERACTION_TYPE(interaction_type)
+    nestpy.RandomGen.rndm().set_seed(int(rng.integers(np.iinfo(np.int64).max)))
+    for i, (energy_deposit, interaction_type) in enumerate(zip(events['e_dep'],
+                                                                events['recoil'])):
+        interaction = nestpy.INTERACTION_TYPE(int(interaction_type))
         y = nest_calc.GetYields(interaction,
                                 energy_deposit,
-                                lxe_density,
+                                LXE_DENSITY,
                                 drift_field,
-                                nucleus_A,
-                                nucleus_Z,
+                                NUCLEUS_A,
+                                NUCLEUS_Z,
                                 )
-        q = nest_calc.GetQuanta(y, lxe_density)
-        quanta.append(q.photons)
-        quanta.append(q.electrons)
-        exciton.append(q.excitons)
-        exciton.append(0)
-        # both S1 and S2
-        recoil += [interaction_type, interaction_type]
-        e_dep += [energy_deposit, energy_deposit]
-
-    inst['amp'] = quanta
+        q = nest_calc.GetQuanta(y, LXE_DENSITY)
+        events['photons'][i] = q.photons
+        events['electrons'][i] = q.electrons
+        events['excitons'][i] = q.excitons
+    return events
+
+
+def _rand_positions(rng, n_events, tpc_length, tpc_radius) -> dict:
+    """Positions of n_events events, uniform in the TPC"""
+    r = np.sqrt(rng.uniform(0, tpc_radius ** 2, n_events))
+    t = rng.uniform(-np.pi, np.pi, n_events)
+    return dict(x=r * np.cos(t),
+                y=r * np.sin(t),
+                z=rng.uniform(-tpc_length, 0, n_events),
+                )
+
+
+def _fill_instructions(inst, events, start, n_events, chunk_size, n_chunk, drift_field):
+    """
+    Fill the S1 and S2 instructions (alternating) of the events, the
+    first event is event <start> out of n_events
+    """
+    total_time = chunk_size * n_chunk
+    n = len(inst) // 2
+    uniform_times = total_time * (np.arange(start, start + n) + 0.5) / n_events
+
+    inst['time'] = np.repeat(uniform_times, 2) * int(1e9)
+    inst['event_number'] = np.digitize(inst['time'],
+                                       1e9 * np.arange(n_chunk) *
+                                       chunk_size) - 1
+    inst['type'] = np.tile([1, 2], n)
     inst['local_field'] = drift_field
-    inst['n_excitons'] = exciton
-    inst['recoil'] = recoil
-    inst['e_dep'] = e_dep
-    for field in inst.dtype.names:
-        if np.any(inst[field] == -1):
-            warn(f'{field} is not (fully) filled')
+
+    # both S1 and S2
+    for field in ('x', 'y', 'z', 'e_dep', 'recoil'):
+        inst[field] = np.repeat(events[field], 2)
+    inst['amp'][::2] = events['photons']
+    inst['amp'][1::2] = events['electrons']
+    inst['n_excitons'][::2] = events['excitons']
+    inst['n_excitons'][1::2] = 0
+
+
+@export
+def kr83_instructions(
+        event_rate: int,
+        chunk_size: int,
+        n_chunk: int,
+        drift_field: float,
+        tpc_length: float = straxen.tpc_z,
+        tpc_radius: float = straxen.tpc_r,
+        half_life: float = KR83M_HALF_LIFE,
+        n_delay_bins: int = 10,
+        yield_table_cache: ty.Optional[str] = YIELD_TABLE_CACHE,
+        seed: ty.Optional[int] = None,
+) -> np.ndarray:
+    """
+    Generate instructions of Kr83m decays to run WFSim. Each event is
+    an S1 of the 32.1 keV decay, an S2 and an S1 of the 9.4 keV decay,
+    which follows after an exponentially distributed delay. The delay
+    is much shorter than an S2, so the electrons of both decays are in
+    one S2 (NEST gives the electrons of the cascade to the 32.1 keV
+    decay anyway). The positions are drawn as in rand_instructions.
+
+    For Kr83m, NEST reads the mass and atomic number as the max and min
+    delay of the 9.4 keV decay, and the yields of that decay depend on
+    it. We sample the delay ourselves and bin it in n_delay_bins bins of
+    equal probability. The quanta of the events in each bin are sampled
+    from a yield table (see get_yield_table) of NEST with the delay
+    limited to that bin. NEST is seeded for each table, so the
+    instructions only depend on the seed, not on the cached tables.
+
+    For example, pema.inst_to_csv(csv_file,
+    get_inst_from=pema.kr83_instructions, **kwargs).
+
+    :param event_rate: # events per second
+    :param chunk_size: the size of each chunk
+    :param n_chunk: the number of chunks
+    :param drift_field: drift field [V/cm]
+    :param tpc_length: the max depth of the detector
+    :param tpc_radius: the max radius of the detector
+    :param half_life: half life [ns] of the intermediate (9.4 keV)
+        state, sets the delay between the two S1s
+    :param n_delay_bins: number of delay bins of the yield tables
+    :param yield_table_cache: directory to cache the yield tables, None
+        for no caching (see get_yield_table)
+    :param seed: seed of the random generator. If None, the seed is
+        drawn from np.random so that np.random.seed still applies.
+    :return: instructions, three per event (S1, S2, S1)
+    """
+    if seed is None:
+        seed = np.random.randint(np.iinfo(np.int64).max)
+    rng = np.random.default_rng(seed)
+    n_events = event_rate * chunk_size * n_chunk
+    events = _rand_positions(rng, n_events, tpc_length, tpc_radius)
+    mean_life = half_life / np.log(2)
+    delay = rng.exponential(mean_life, n_events)
+
+    # Bins of equal probability, the last one up to KR83M_MAX_LIVES mean lives
+    delay_edges = -mean_life * np.log1p(-np.arange(n_delay_bins) / n_delay_bins)
+    delay_edges = np.append(delay_edges, KR83M_MAX_LIVES * mean_life)
+    delay_bin = np.digitize(delay, delay_edges[1:-1])
+
+    energy_first, energy_second = KR83M_ENERGIES
+    # One column per decay
+    photons, electrons, excitons = np.zeros((3, n_events, 2), dtype=np.int64)
+    for bin_i in range(n_delay_bins):
+        in_bin = delay_bin == bin_i
+        table = get_yield_table(KR83M_NEST_ID, drift_field, sorted(KR83M_ENERGIES),
+                                n_energies=2,
+                                cache_dir=yield_table_cache,
+                                delay_range=tuple(delay_edges[bin_i:bin_i + 2].tolist()))
+        for decay_i, energy in enumerate(KR83M_ENERGIES):
+            (photons[in_bin, decay_i],
+             electrons[in_bin, decay_i],
+             excitons[in_bin, decay_i]) = table.sample(np.full(np.sum(in_bin), energy), rng=rng)
+
+    inst = np.zeros(3 * n_events, dtype=wfsim.instruction_dtype)
+    inst[:] = -1
+    # View with one row per event and a column per instruction
+    per_event = inst.reshape(n_events, 3)
+    total_time = chunk_size * n_chunk
+    time = (total_time * (np.arange(n_events) + 0.5) / n_events * 1e9).astype(np.int64)
+    per_event['time'] = time[:, None]
+    per_event['time'][:, 2] += np.rint(delay).astype(np.int64)
+    inst['event_number'] = np.digitize(inst['time'],
+                                       1e9 * np.arange(n_chunk) *
+                                       chunk_size) - 1
+    per_event['type'] = [1, 2, 1]
+    per_event['recoil'] = KR83M_NEST_ID
+    per_event['local_field'] = drift_field
+    for field in ('x', 'y', 'z'):
+        per_event[field] = events[field][:, None]
+    per_event['e_dep'] = [energy_first, energy_first + energy_second, energy_second]
+    per_event['amp'][:, 0] = photons[:, 0]
+    per_event['amp'][:, 1] = electrons.sum(axis=1)
+    per_event['amp'][:, 2] = photons[:, 1]
+    per_event['n_excitons'][:, 0] = excitons[:, 0]
+    per_event['n_excitons'][:, 1] = 0
+    per_event['n_excitons'][:, 2] = excitons[:, 1]
+    _warn_not_filled(inst)
     return inst
 
 
+@export
+class YieldTable:
+    """
+    Mean and covariance of the photons, electrons and excitons that NEST
+    gives for a grid of energies, see get_yield_table
+    """
+    __slots__ = ('energies', 'mean', 'cov')
+
+    def __init__(self, energies, mean, cov):
+        self.energies = energies
+        self.mean = mean
+        self.cov = cov
+
+    def __repr__(self):
+        return (f'YieldTable({len(self.energies)} energies '
+                f'{self.energies[0]:.3g}-{self.energies[-1]:.3g} keV)')
+
+    def sample(self, energy, rng=np.random) -> tuple:
+        """
+        Sample the quanta for each energy from a multivariate normal
+        distribution with the interpolated mean and covariance
+
+        :return: photons, electrons, excitons
+        """
+        energy = np.asarray(energy, dtype=np.float64)
+        # Linear interpolation, a weighted mean of covariances is a covariance
+        i = np.searchsorted(self.energies, energy).clip(1, len(self.energies) - 1)
+        w = ((energy - self.energies[i - 1]) /
+             (self.energies[i] - self.energies[i - 1])).clip(0, 1)
+        mean = self.mean[i - 1] * (1 - w[:, None]) + self.mean[i] * w[:, None]
+        cov = self.cov[i - 1] * (1 - w[:, None, None]) + self.cov[i] * w[:, None, None]
+
+        # cov = vec @ diag(val) @ vec.T, excitons may have (almost) no variance
+        val, vec = np.linalg.eigh(cov)
+        scale = vec * np.sqrt(val.clip(0))[:, None, :]
+        normal = rng.standard_normal(size=(len(energy), 3))
+        quanta = mean + np.einsum('nij,nj->ni', scale, normal)
+        quanta = np.rint(quanta).clip(0).astype(np.int64)
+        return quanta[:, 0], quanta[:, 1], quanta[:, 2]
+
+
+@export
+def get_yield_table(interaction_type: int,
+                    drift_field: float,
+                    energy_range: ty.Union[tuple, list, np.ndarray],
+                    n_energies: int = 50,
+                    n_samples: int = 1000,
+                    cache_dir: ty.Optional[str] = YIELD_TABLE_CACHE,
+                    delay_range: ty.Optional[tuple] = None,
+                    seed: ty.Optional[int] = None,
+                    ) -> YieldTable:
+    """
+    Get the mean and covariance of the quanta of NEST for n_energies
+    energies in the energy_range. For each energy, NEST is called
+    n_samples times, the table is cached in the cache_dir. NEST is
+    seeded, so the table is the same whether it is cached or not.
+
+    :param interaction_type: NEST interaction type (see rand_instructions)
+    :param drift_field: drift field [V/cm]
+    :param energy_range: the energy range (in keV)
+    :param n_energies: number of energies in the table
+    :param n_samples: number of NEST samples per energy
+    :param cache_dir: directory to cache the table, None for no caching
+    :param delay_range: (min, max) delay [ns] of the second decay, only
+        for Kr83m. NEST reads these instead of the mass and atomic number,
+        see kr83_instructions.
+    :param seed: seed of NEST for the table. If None, it follows from
+        the other parameters, so each table has its own fixed seed.
+    :return: YieldTable
+    """
+    if delay_range is not None and int(interaction_type) != KR83M_NEST_ID:
+        raise ValueError(f'Only Kr83m ({KR83M_NEST_ID}) takes a delay_range, '
+                         f'not {interaction_type}')
+    # For Kr83m, NEST takes the max and min delay instead of A and Z
+    nucleus = (NUCLEUS_A, NUCLEUS_Z) if delay_range is None else delay_range[::-1]
+    energies = np.linspace(*energy_range, n_energies)
+    table_config = dict(
+        interaction_type=int(interaction_type),
+        drift_field=float(drift_field),
+        energies=energies.tolist(),
+        n_samples=n_samples,
+        detector=(*map(float, nucleus), LXE_DENSITY),
+        nestpy=getattr(nestpy, '__version__', None),
+    )
+    if seed is not None:
+        table_config['seed'] = int(seed)
+    key = strax.deterministic_hash(table_config)
+    if seed is None:
+        # The key is base32, which are valid base36 digits
+        seed = int(key, 36)
+    cache_file = None if cache_dir is None else os.path.join(cache_dir, f'yields_{key}.npz')
+    if cache_file is not None and os.path.exists(cache_file):
+        cached = np.load(cache_file)
+        return YieldTable(cached['energies'], cached['mean'], cached['cov'])
+
+    nest_calc = nestpy.NESTcalc(nestpy.VDetector())
+    interaction = nestpy.INTERACTION_TYPE(int(interaction_type))
+    nestpy.RandomGen.rndm().set_seed(seed)
+    mean = np.zeros((n_energies, 3))
+    cov = np.zeros((n_energies, 3, 3))
+    samples = np.zeros((n_samples, 3))
+    for energy_i, energy_deposit in enumerate(tqdm(energies, desc='making yield table')):
+        for sample_i in range(n_samples):
+            y = nest_calc.GetYields(interaction,
+                                    energy_deposit,
+                                    LXE_DENSITY,
+                                    drift_field,
+                                    *nucleus,
+                                    )
+            q = nest_calc.GetQuanta(y, LXE_DENSITY)
+            samples[sample_i] = q.photons, q.electrons, q.excitons
+        mean[energy_i] = samples.mean(axis=0)
+        cov[energy_i] = np.cov(samples, rowvar=False)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write and move, so parallel jobs never read half a file
+        temp_file = f'{cache_file}.{os.getpid()}.npz'
+        np.savez(temp_file, energies=energies, mean=mean, cov=cov)
+        os.replace(temp_file, cache_file)
+    return YieldTable(energies, mean, cov)
+
+
 @export
 def inst_to_csv(csv_file: str,
                 get_inst_from=rand_instructions,
@@ -114,3 +524,135 @@ def inst_to_csv(csv_file: str,
         warn('Removing zero amplitude from instruction, but that shouldn\'t be here')
         df = df[df['amp'] > 0]
     df.to_csv(csv_file, index=False)
+
+
+@export
+def inst_to_file(inst_file: str,
+                 get_inst_from=rand_instructions,
+                 rows_per_write: int = 1_000_000,
+                 **kwargs) -> int:
+    """
+    Write instructions to a binary .npy file, which can be memory
+    mapped (see load_instructions). Contrary to inst_to_csv, the
+    instructions are written in blocks, without a DataFrame or a text
+    round trip.
+
+    :param inst_file: path to the .npy file
+    :param get_inst_from: function to generate the S1 S2 instructions,
+        it may return an array or an iterable of arrays
+    :param rows_per_write: number of instructions to write at once
+    :param kwargs: key word arguments to give to the get_inst_from-function
+        (e.g. the block_size of rand_instructions)
+    :return: number of instructions written
+    """
+    if not inst_file.endswith('.npy'):
+        raise ValueError(f'{inst_file} should be a .npy file')
+    dtype = np.dtype(wfsim.instruction_dtype)
+    inst = get_inst_from(**kwargs)
+    blocks = [inst] if isinstance(inst, np.ndarray) else inst
+
+    n_written = 0
+    warned = False
+    # Write and move, so nobody reads half a file
+    temp_file = f'{inst_file}.{os.getpid()}.tmp'
+    try:
+        with open(temp_file, 'wb') as f:
+            # The number of instructions is only known at the end, reserve
+            # space for the header and update it when done
+            header_length = len(_npy_header(dtype, np.iinfo(np.int64).max))
+            f.write(_npy_header(dtype, 0, header_length))
+            for block in blocks:
+                if block.dtype != dtype:
+                    raise ValueError(f'Got dtype {block.dtype}, expected {dtype}')
+                for start in range(0, len(block), rows_per_write):
+                    sub_block = block[start:start + rows_per_write]
+                    is_zero = sub_block['amp'] <= 0
+                    if np.any(is_zero):
+                        if not warned:
+                            warn('Removing zero amplitude from instruction, '
+                                 'but that shouldn\'t be here')
+                            warned = True
+                        sub_block = sub_block[~is_zero]
+                    f.write(np.ascontiguousarray(sub_block).tobytes())
+                    n_written += len(sub_block)
+            f.seek(0)
+            f.write(_npy_header(dtype, n_written, header_length))
+        os.replace(temp_file, inst_file)
+    finally:
+        # Only left if writing failed, don't keep half a file
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return n_written
+
+
+def _npy_header(dtype, n, length=None) -> bytes:
+    """Header of a .npy file (version 1.0) of n items, padded to length"""
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                   'fortran_order': False,
+                   'shape': (n,)})
+    magic = np.lib.format.magic(1, 0)
+    # Magic, 2 bytes for the header length, header and newline
+    if length is None:
+        length = len(magic) + 2 + len(header) + 1
+        length += -length % 64
+    n_pad = length - len(magic) - 2 - len(header) - 1
+    if n_pad < 0:
+        raise ValueError('Header does not fit')
+    header = (header + ' ' * n_pad + '\n').encode('latin1')
+    return magic + len(header).to_bytes(2, 'little') + header
+
+
+@export
+def load_instructions(inst_file: str, mmap: bool = True) -> np.ndarray:
+    """
+    Load instructions written by inst_to_file (or inst_to_csv)
+
+    :param inst_file: path to the .npy (or .csv) file
+    :param mmap: memory map the .npy file instead of reading it
+    :return: instructions of wfsim.instruction_dtype
+    """
+    if inst_file.endswith('.csv'):
+        return wfsim.strax_interface.instruction_from_csv(inst_file)
+    inst = np.load(inst_file, mmap_mode='r' if mmap else None)
+    expected_dtype = np.dtype(wfsim.instruction_dtype)
+    if inst.dtype != expected_dtype:
+        raise ValueError(f'{inst_file} has dtype {inst.dtype}, expected {expected_dtype}')
+    return inst
+
+
+@export
+def cached_instructions(cache_dir: str,
+                        get_inst_from=rand_instructions,
+                        **kwargs) -> str:
+    """
+    Get the path to the instructions of get_inst_from(**kwargs) in the
+    cache_dir, write them with inst_to_file if they are not there yet.
+    Only use this with a seed, otherwise the instructions of the same
+    kwargs are not the same.
+
+    :return: path to the .npy file
+    """
+    key = strax.deterministic_hash(dict(get_inst_from=get_inst_from.__name__, **kwargs))
+    inst_file = os.path.join(cache_dir, f'{get_inst_from.__name__}_{key}.npy')
+    if not os.path.exists(inst_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        inst_to_file(inst_file, get_inst_from=get_inst_from, **kwargs)
+    return inst_file
+
+
+@export
+class RawRecordsFromFaxNpy(wfsim.RawRecordsFromFaxNT):
+    """
+    RawRecordsFromFaxNT that also reads instructions from .npy files.
+    The reader follows from the suffix of the fax_file when setting up
+    the plugin, other files are read by RawRecordsFromFaxNT (as csv).
+    pema_context only registers it for npy_instructions, as it changes
+    the lineage of raw_records.
+    """
+
+    def get_instructions(self):
+        if self.config['fax_file'] and self.config['fax_file'].endswith('.npy'):
+            # check_instructions makes a copy anyway
+            self.instructions = load_instructions(self.config['fax_file'], mmap=False)
+        else:
+            super().get_instructions()
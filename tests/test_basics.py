@@ -31,6 +31,11 @@ class SimpleTests(TestCase):
     def test_show(self):
         pema.compare_plots._save_and_show('a', '.test', show=True, peak_i=1)
 
+    def test_precompile(self):
+        pema.precompile_in_background().join()
+        assert pema.matching._match_peaks.signatures
+        assert pema.matching._preflight_flags.signatures
+
     def test_warnings_for_matching(self):
         with self.assertRaises(ValueError):
             peak1 = np.zeros(1, dtype=[(('bla bla', 'bla'), np.int8)])
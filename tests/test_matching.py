@@ -1,5 +1,6 @@
 import pema
 import numpy as np
+import pytest
 from hypothesis import given, strategies, example, settings
 import strax
 
@@ -86,6 +87,141 @@ def test_matching(data_length,
     assert len(t_matched) == len(truth)
 
 
+@settings(max_examples=100, deadline=None)
+@given(
+    # Max length of the data
+    strategies.integers(min_value=0, max_value=1000),
+    # Max length of the truth
+    strategies.integers(min_value=0, max_value=1000),
+    # Max duration in [ns]
+    strategies.integers(min_value=0, max_value=10_000_000),
+    # Number of peak-types in data
+    strategies.integers(min_value=1, max_value=3),
+    # Number of peak-types in truth
+    strategies.integers(min_value=1, max_value=3),
+    # Matching fuzz
+    strategies.integers(min_value=0, max_value=10_000),
+)
+@example(data_length=10,
+         truth_length=10,
+         max_duration=int(1e9),
+         n_data_types=2,
+         n_truth_types=2,
+         matching_fuzz=0)
+def test_sweep_engine(data_length,
+                      truth_length,
+                      max_duration,
+                      n_data_types,
+                      n_truth_types,
+                      matching_fuzz):
+    """The sweep engine should give exactly the same results"""
+    data, truth = _create_dummy_records(data_length,
+                                        n_data_types,
+                                        truth_length,
+                                        n_truth_types,
+                                        max_duration,
+                                        )
+    t_windows, d_windows = pema.match_peaks(truth, data, matching_fuzz=matching_fuzz)
+    t_sweep, d_sweep = pema.match_peaks(truth, data, matching_fuzz=matching_fuzz, engine='sweep')
+    assert np.all(t_windows == t_sweep)
+    assert np.all(d_windows == d_sweep)
+
+
+@settings(max_examples=100, deadline=None)
+@given(
+    # Max length of the data
+    strategies.integers(min_value=0, max_value=1000),
+    # Max length of the truth
+    strategies.integers(min_value=0, max_value=1000),
+    # Max duration in [ns]
+    strategies.integers(min_value=0, max_value=10_000_000),
+    # Matching fuzz
+    strategies.integers(min_value=0, max_value=10_000),
+    # Number of threads
+    strategies.integers(min_value=2, max_value=4),
+    # Engine
+    strategies.sampled_from(('windows', 'sweep')),
+)
+@example(data_length=10,
+         truth_length=10,
+         max_duration=int(1e9),
+         matching_fuzz=0,
+         n_threads=2,
+         engine='windows')
+def test_threaded_matching(data_length,
+                           truth_length,
+                           max_duration,
+                           matching_fuzz,
+                           n_threads,
+                           engine):
+    """Matching the clusters in threads should give the same results"""
+    data, truth = _create_dummy_records(data_length, 2, truth_length, 2, max_duration)
+    t_serial, d_serial = pema.match_peaks(truth, data, matching_fuzz=matching_fuzz)
+    t_threads, d_threads = pema.match_peaks(truth, data,
+                                            matching_fuzz=matching_fuzz,
+                                            engine=engine,
+                                            n_threads=n_threads)
+    assert np.all(t_serial == t_threads)
+    assert np.all(d_serial == d_threads)
+
+
+@settings(max_examples=100, deadline=None)
+@given(
+    # Max length of the data
+    strategies.integers(min_value=0, max_value=1000),
+    # Max length of the truth
+    strategies.integers(min_value=0, max_value=1000),
+    # Max duration in [ns]
+    strategies.integers(min_value=0, max_value=10_000_000),
+    # Matching fuzz
+    strategies.integers(min_value=0, max_value=10_000),
+    # Number of chunks of the data
+    strategies.integers(min_value=1, max_value=10),
+    # Number of chunks of the truth
+    strategies.integers(min_value=1, max_value=10),
+)
+@example(data_length=10,
+         truth_length=10,
+         max_duration=int(1e9),
+         matching_fuzz=0,
+         n_data_chunks=3,
+         n_truth_chunks=2)
+def test_iter_matching(data_length,
+                       truth_length,
+                       max_duration,
+                       matching_fuzz,
+                       n_data_chunks,
+                       n_truth_chunks):
+    """Matching the chunks should give the same results as matching all at once"""
+    data, truth = _create_dummy_records(data_length, 2, truth_length, 2, max_duration)
+    t_matched, d_matched = pema.match_peaks(truth, data, matching_fuzz=matching_fuzz)
+    result = list(pema.iter_match_peaks(np.array_split(truth, n_truth_chunks),
+                                        np.array_split(data, n_data_chunks),
+                                        matching_fuzz=matching_fuzz))
+    t_chunks = np.concatenate([t_matched[:0]] + [t for t, _ in result])
+    d_chunks = np.concatenate([d_matched[:0]] + [d for _, d in result])
+    assert np.all(t_matched == t_chunks)
+    assert np.all(d_matched == d_chunks)
+
+
+def test_match_peak_columns():
+    """Matching only the columns should give the same outcomes"""
+    data, truth = _create_dummy_records(500, 2, 500, 2, 10_000_000)
+    t_matched, d_matched = pema.match_peaks(truth, data)
+    truth_columns = {k: truth[k] for k in ('time', 'endtime', 'id', 'type', 'area')}
+    result = pema.match_peak_columns(truth_columns, data)
+    assert isinstance(result, pema.MatchResult)
+    assert np.all(result.outcome1 == t_matched['outcome'])
+    assert np.all(result.matched_to1 == t_matched['matched_to'])
+    assert np.all(result.outcome2 == d_matched['outcome'])
+    assert np.all(result.matched_to2 == d_matched['matched_to'])
+    # The input is not modified
+    assert 'outcome' not in truth.dtype.names
+    # Skipping the preflight checks of checked input gives the same
+    checked = pema.match_peak_columns(truth_columns, data, checked=(True, True))
+    assert np.all(checked.outcome1 == result.outcome1)
+    assert np.all(checked.matched_to2 == result.matched_to2)
+
 @settings(max_examples=100, deadline=None)
 @given(
     # Max length of the data
@@ -161,31 +297,241 @@ def test_peak_merges():
     parent['type'] = 1
     fragment['type'] = 1, 2
     pema.matching.handle_peak_merge(parent[0], fragment, unknown_types)
-    assert parent['outcome'] == 'split_and_misid'
-    assert fragment[0]['outcome'] == 'merged'
-    assert fragment[1]['outcome'] == 'merged_to_s1'
+    assert parent['outcome'] == pema.outcome_code('split_and_misid')
+    assert fragment[0]['outcome'] == pema.outcome_code('merged')
+    assert fragment[1]['outcome'] == pema.outcome_code('merged_to_s1')
 
     parent['type'] = 1
     fragment['type'] = 1, 0
     pema.matching.handle_peak_merge(parent[0], fragment, unknown_types)
-    assert parent['outcome'] == 'chopped'
+    assert parent['outcome'] == pema.outcome_code('chopped')
 
     parent['type'] = 1
     fragment['type'] = 1, 2
     pema.matching.handle_peak_merge(parent[0], fragment, unknown_types)
-    assert parent['outcome'] == 'split_and_misid'
+    assert parent['outcome'] == pema.outcome_code('split_and_misid')
 
     parent['type'] = 1
     fragment['type'] = 1, 1
     pema.matching.handle_peak_merge(parent[0], fragment, unknown_types)
-    assert parent['outcome'] == 'split'
+    assert parent['outcome'] == pema.outcome_code('split')
 
     parent['type'] = 0
     fragment['type'] = 1, 1
     pema.matching.handle_peak_merge(parent[0], fragment, unknown_types)
-    assert fragment[0]['outcome'] == 'merged_to_unknown'
+    assert fragment[0]['outcome'] == pema.outcome_code('merged_to_unknown')
 
     parent['type'] = 1
     fragment['type'] = 0, 0
     pema.matching.handle_peak_merge(parent[0], fragment, unknown_types)
-    assert parent['outcome'] == 'split_and_unclassified'
+    assert parent['outcome'] == pema.outcome_code('split_and_unclassified')
+
+
+def test_outcome_codes():
+    """Labels should survive the round trip to the integer codes"""
+    for label in list(pema.matching.OUTCOME_LABELS.values()) + [
+            'misid_as_s1', 'misid_as_s2', 'merged_to_s0', 'merged_to_s2']:
+        code = pema.outcome_code(label)
+        assert np.iinfo(pema.matching.OUTCOME_DTYPE).max >= code
+        assert pema.outcome_label(code) == label
+    codes = np.array([pema.outcome_code('found'), pema.outcome_code('misid_as_s1')] * 2)
+    assert list(pema.outcome_labels(codes)) == ['found', 'misid_as_s1'] * 2
+
+
+def test_preflight_peaks():
+    """Check the flags of the preflight checks"""
+    time = np.array([0, 10, 10, 5, 30])
+    endtime = np.array([20, 10, 15, 4, 40])
+    ids = np.array([0, 1, 1, 3, 0])
+    report = pema.preflight_peaks(time, endtime, ids)
+    assert not report.is_sorted
+    assert not report.valid_intervals
+    assert report.n_negative_length == 1
+    assert report.n_zero_length == 1
+    assert report.n_overlapping == 3
+    assert not report.unique_ids
+    assert report.flags[3] & pema.matching.PREFLIGHT_UNSORTED
+    assert report.flags[2] & pema.matching.PREFLIGHT_DUPLICATE_ID
+    assert report.flags[4] & pema.matching.PREFLIGHT_DUPLICATE_ID
+    assert not report.flags[0]
+
+    report = pema.preflight_peaks(time[:3], endtime[:3])
+    assert report.is_sorted and report.valid_intervals and report.unique_ids
+
+
+def test_one_signature_for_all_dtypes():
+    """The kernels should not be compiled again for other dtypes of the peaks"""
+    data, truth = _create_dummy_records(100, 2, 100, 2, 10_000)
+    pema.match_peaks(truth, data)
+    n_signatures = len(pema.matching._match_peaks.signatures)
+    truth_extra = pema.append_fields(truth, 'extra', np.ones(len(truth), dtype=np.float32))
+    data_extra = data.astype([(name, np.float32 if name == 'area' else data.dtype[name])
+                              for name in data.dtype.names])
+    pema.match_peaks(truth_extra, data_extra)
+    assert len(pema.matching._match_peaks.signatures) == n_signatures
+
+
+def test_match_many():
+    """Matching in a thread pool should give the results in the same order"""
+    pairs = [_create_dummy_records(length, 2, length, 2, 10_000)[::-1]
+             for length in (0, 10, 100, 1000)]
+    results = pema.match_many(pairs, max_workers=2, matching_fuzz=10)
+    assert len(results) == len(pairs)
+    for (truth, data), (t_many, d_many) in zip(pairs, results):
+        t_matched, d_matched = pema.match_peaks(truth, data, matching_fuzz=10)
+        assert np.all(t_matched == t_many)
+        assert np.all(d_matched == d_many)
+
+
+def test_match_multi_fuzz():
+    """Matching for many fuzz values at once should be the same as one by one"""
+    data, truth = _create_dummy_records(1000, 2, 1000, 2, 1_000_000)
+    fuzzes = (0, 10, 1000, 100_000)
+    results = pema.match_multi_fuzz(truth, data, fuzzes)
+    for matching_fuzz in fuzzes:
+        t_matched, d_matched = pema.match_peaks(truth, data, matching_fuzz=matching_fuzz)
+        result = results[matching_fuzz]
+        assert np.all(result.outcome1 == t_matched['outcome'])
+        assert np.all(result.matched_to1 == t_matched['matched_to'])
+        assert np.all(result.outcome2 == d_matched['outcome'])
+        assert np.all(result.matched_to2 == d_matched['matched_to'])
+
+
+def test_id_to_index():
+    """Get the index of ids for consecutive, sorted and unsorted ids"""
+    time_ids = pema.match_plugins.ids_from_time(np.sort(np.random.randint(0, 100, 50)))
+    for ids in (np.arange(10, 20), np.array([1, 5, 7, 9, 12]), np.array([9, 1, 12, 7, 5]),
+                time_ids):
+        search = ids[::-2]
+        index = pema.id_to_index(search, ids)
+        assert np.all(ids[index] == search)
+    with pytest.raises(ValueError):
+        pema.id_to_index([6], np.array([1, 5, 7]))
+
+
+def test_ids_from_time():
+    """Ids are unique and increasing, also for items at the same time"""
+    time = np.sort(np.random.randint(0, 100, 1000))
+    ids = pema.match_plugins.ids_from_time(time)
+    assert np.all(np.diff(ids) > 0)
+    assert np.all(ids >= time)
+    # The ids do not fit in the chunk
+    with pytest.raises(ValueError):
+        pema.match_plugins.ids_from_time(time, end=time[-1] + 1, start=0)
+
+
+def test_ids_from_time_chunk_end():
+    """Items at (or, with a negative length, after) the end of the chunk get ids before it"""
+    start, end = 0, 100
+    # Zero-length items at the end, an item with a negative length after it
+    time = np.array([10, 10, 98, 99, 100, 100, 105])
+    ids = pema.match_plugins.ids_from_time(time, end=end, start=start)
+    assert np.all(np.diff(ids) > 0)
+    assert ids[0] >= start
+    assert ids[-1] < end
+    assert np.all(ids[:2] == [10, 11])
+    # Also unique if the times are not sorted
+    ids = pema.match_plugins.ids_from_time(time[::-1], end=end, start=start)
+    assert np.all(np.diff(ids) > 0)
+    assert ids[-1] < end
+
+
+def test_fill_start_end():
+    """The truth events may be a subset of the truth numbers, in any order"""
+    truth = np.zeros(6, dtype=strax.time_fields + [(('Number', 'event_number'), np.int64)])
+    truth['time'] = [0, 5, 10, 20, 30, 40]
+    truth['endtime'] = truth['time'] + [20, 2, 3, 4, 5, 6]
+    truth['event_number'] = [0, 0, 1, 1, 3, 3]
+    truth_event = np.zeros(2, dtype=strax.time_fields + [(('Number', 'truth_number'), np.int64)])
+    truth_event['truth_number'] = [3, 0]
+    pema.match_plugins.fill_start_end(truth, truth_event)
+    assert np.all(truth_event['time'] == [30, 0])
+    assert np.all(truth_event['endtime'] == [46, 20])
+    truth_event['truth_number'] = [2, 3]
+    with pytest.raises(ValueError):
+        pema.match_plugins.fill_start_end(truth, truth_event)
+
+
+def test_group_start_end():
+    """Compare the grouped start and end to masking each truth number"""
+    for is_sorted in (True, False):
+        truth_number = np.random.randint(0, 50, 1000)
+        if is_sorted:
+            truth_number.sort()
+        starts = np.random.randint(0, 1_000_000, 1000)
+        stops = starts + np.random.randint(0, 1000, 1000)
+        unique_numbers, start, stop = pema.match_plugins.group_start_end(
+            truth_number, starts, stops)
+        assert np.all(unique_numbers == np.unique(truth_number))
+        for number, first, last in zip(unique_numbers, start, stop):
+            mask = truth_number == number
+            assert first == starts[mask].min()
+            assert last == stops[mask].max()
+
+
+def test_acceptance_sweep():
+    """Compare the acceptance of the sweep to setting the penalties one by one"""
+    n = 1000
+    truth = np.zeros(n, dtype=[('type', np.int16),
+                               ('outcome', pema.matching.OUTCOME_DTYPE),
+                               ('rec_bias', np.float64)])
+    truth['type'] = np.random.randint(0, 3, n)
+    truth['outcome'] = np.random.choice(
+        [pema.matching.outcome_code(o) for o in
+         ('found', 'missed', 'merged', 'split', 'misid_as_s1', 'split_and_misid')], n)
+    truth['rec_bias'] = np.random.uniform(0, 1.5, n)
+    min_s2_bias_recs = (0.5, 0.85, 1.)
+    penalty_s2_bys = ((('misid_as_s1', -1.), ('split_and_misid', -1.)),
+                      (),
+                      (('split', 0.5), ('split', 0.2)))
+    acceptance = pema.acceptance_sweep(truth, min_s2_bias_recs, penalty_s2_bys)
+    assert acceptance.shape == (len(penalty_s2_bys), len(min_s2_bias_recs), n)
+
+    s1_mask = truth['type'] == 1
+    s2_mask = truth['type'] == 2
+    for penalty_i, penalty_s2_by in enumerate(penalty_s2_bys):
+        for bias_i, min_s2_bias_rec in enumerate(min_s2_bias_recs):
+            expected = np.zeros(n)
+            expected[s1_mask] = truth['outcome'][s1_mask] == pema.matching.OUTCOME_FOUND
+            expected[s2_mask] = truth['rec_bias'][s2_mask] > min_s2_bias_rec
+            for outcome, penalty in penalty_s2_by:
+                expected[s2_mask & (truth['outcome'] == pema.matching.outcome_code(outcome))] = penalty
+            assert np.all(acceptance[penalty_i, bias_i] == expected)
+
+
+def test_fragment_table():
+    """Compare the fragments to selecting the overlapping peaks of each truth"""
+    peaks, truth = _create_dummy_records(data_length=200, n_data_types=2,
+                                         truth_length=50, n_truth_types=2,
+                                         max_duration=10_000_000)
+    for matching_fuzz in (0, 1000):
+        table = pema.fragment_table(truth, peaks, matching_fuzz=matching_fuzz)
+        assert len(table.offsets) == len(truth) + 1
+        for i, t in enumerate(truth):
+            overlap = ((peaks['time'] < t['endtime'] + matching_fuzz) &
+                       (peaks['endtime'] > t['time'] - matching_fuzz))
+            fragments = table.fragment_id[table.offsets[i]:table.offsets[i + 1]]
+            if np.sum(overlap) > 1:
+                assert np.all(fragments == peaks['id'][overlap])
+            else:
+                assert not len(fragments)
+        assert np.all((table.overlap_fraction >= 0) & (table.overlap_fraction <= 1))
+
+
+def test_pair_metrics():
+    """Compare the pair metrics to looking up the matched peak of each truth"""
+    peaks, truth = _create_dummy_records(data_length=200, n_data_types=2,
+                                         truth_length=50, n_truth_types=2,
+                                         max_duration=10_000_000)
+    truth['id'] = np.arange(len(truth))
+    result = pema.match_peak_columns(truth, peaks)
+    metrics = pema.pair_metrics(truth, peaks, result.matched_to1)
+    for t, matched_to, m in zip(truth, result.matched_to1, metrics):
+        if matched_to == pema.matching.INT_NAN:
+            assert m['start_offset'] == pema.matching.INT_NAN
+            continue
+        p = peaks[peaks['id'] == matched_to][0]
+        assert m['start_offset'] == p['time'] - t['time']
+        assert m['end_offset'] == p['endtime'] - t['endtime']
+        assert np.isclose(m['center_offset'],
+                          (p['time'] + p['endtime']) / 2 - (t['time'] + t['endtime']) / 2)
@@ -154,7 +154,7 @@ class TestStack(unittest.TestCase):
         peaks_2 = st2.get_array(run_id, 'match_acceptance_extended')
 
         assert 'rec_area' in peaks_1.dtype.names
-        assert np.sum(peaks_1[peaks_1['outcome'] == 'missed']['rec_area']) == 0
+        assert np.sum(peaks_1[peaks_1['outcome'] == pema.matching.OUTCOME_MISSED]['rec_area']) == 0
 
         if 'run_id' not in peaks_1.dtype.names:
             peaks_1 = pema.append_fields(peaks_1, 'run_id', [run_id] * len(peaks_1))
@@ -190,6 +190,70 @@ class TestStack(unittest.TestCase):
             )
             plt.clf()
 
+    def test_later_peaks_matched(self):
+        st = self.script.st
+        truth_matched = st.get_array(run_id, 'truth_matched')
+        peaks_matched = st.get_array(run_id, 'peaks_matched')
+        assert len(peaks_matched) == len(st.get_array(run_id, 'peak_basics'))
+        # Peaks found for the truth should be found for the peaks as well
+        found = truth_matched['outcome'] == pema.matching.OUTCOME_FOUND
+        peaks_found = peaks_matched['outcome'] == pema.matching.OUTCOME_FOUND
+        assert np.all(np.in1d(truth_matched['matched_to'][found], peaks_matched['id'][peaks_found]))
+
+    def test_later_peak_join(self):
+        st = self.script.st.new_context()
+        st.register(pema.peak_join_plugin({'peak_basics': ('area', 'range_50p_area')},
+                                          prefix='joined_'))
+        truth = st.get_array(run_id, ('truth_extended', 'truth_peaks_joined'))
+        # Same as the fields added by the AcceptanceComputer
+        assert np.all(truth['joined_area'] == truth['rec_area'])
+        assert np.all(truth['joined_range_50p_area'] == truth['rec_range_50p_area'])
+
+    def test_later_adaptive_window(self):
+        st = self.script.st.new_context()
+        st.set_config(dict(adapt_lookup_window=True))
+        for target in ('truth_matched', 'truth_events'):
+            adapted = st.get_array(run_id, target)
+            fixed = self.script.st.get_array(run_id, target)
+            assert np.all(adapted == fixed)
+
+    def test_later_fused_truth_extended(self):
+        st = self.script.st.new_context()
+        st.register(pema.FusedTruthExtended)
+        fused = st.get_array(run_id, 'truth_extended')
+        merged = self.script.st.get_array(run_id, 'truth_extended')
+        assert fused.dtype == merged.dtype
+        for field in merged.dtype.names:
+            assert np.array_equal(fused[field], merged[field], equal_nan=True), field
+
+    def test_later_pair_metrics(self):
+        st = self.script.st.new_context()
+        st.set_config(dict(add_pair_metrics=True))
+        truth = st.get_array(run_id, ('truth', 'truth_matched'))
+        found = truth['outcome'] == pema.matching.OUTCOME_FOUND
+        assert np.all(truth['overlap_fraction'][found] >= 0)
+        assert np.all(truth['overlap_fraction'][found] <= 1)
+
+    def test_later_fused_pair_metrics(self):
+        st = self.script.st.new_context()
+        st.set_config(dict(add_pair_metrics=True))
+        merged = st.get_array(run_id, 'truth_extended')
+        st.register(pema.FusedTruthExtended)
+        fused = st.get_array(run_id, 'truth_extended')
+        assert 'overlap_fraction' in fused.dtype.names
+        assert fused.dtype == merged.dtype
+
+    def test_later_csv_lineage(self):
+        """Only .npy instructions should change the lineage of raw_records"""
+        st = self.script.st
+        assert st._plugin_class_registry['raw_records'] is wfsim.RawRecordsFromFaxNT
+        st_npy = st.new_context()
+        st_npy.register(pema.RawRecordsFromFaxNpy)
+        assert st.key_for(run_id, 'raw_records') != st_npy.key_for(run_id, 'raw_records')
+        st_wfsim = st.new_context()
+        st_wfsim.register(wfsim.RawRecordsFromFaxNT)
+        assert st.key_for(run_id, 'raw_records') == st_wfsim.key_for(run_id, 'raw_records')
+
     def test_later_make_ev_matched(self):
         st = self.script.st
         st.get_array(run_id, 'truth_events')
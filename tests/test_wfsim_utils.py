@@ -1,4 +1,9 @@
+import os
+import tempfile
+
+import numpy as np
 import pema
+import pytest
 import straxen
 import wfsim
 
@@ -16,3 +21,106 @@ _input_dict = dict(
 
 def test_rand_instructions():
     pema.rand_instructions(**_input_dict)
+
+
+def test_rand_instructions_yield_tables():
+    """The quanta from the yield tables should follow those of NEST per event"""
+    # One energy and recoil type, so that the S1 and S2 are anti-correlated
+    kwargs = dict(**{**_input_dict, 'energy_range': [5, 5.1], 'nest_inst_types': [8]},
+                  seed=42)
+    per_event = pema.rand_instructions(**kwargs)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        from_tables = pema.rand_instructions(**kwargs, use_yield_tables=True,
+                                             yield_table_cache=temp_dir)
+        # NEST is seeded, the cached table gives the same instructions
+        assert from_tables.tobytes() == pema.rand_instructions(
+            **kwargs, use_yield_tables=True, yield_table_cache=temp_dir).tobytes()
+    assert per_event.dtype == from_tables.dtype
+    for quanta_type in (1, 2):
+        amp = per_event[per_event['type'] == quanta_type]['amp']
+        amp_tables = from_tables[from_tables['type'] == quanta_type]['amp']
+        assert abs(amp_tables.mean() / amp.mean() - 1) < 0.1
+        assert abs(amp_tables.std() / amp.std() - 1) < 0.2
+    correlation = [np.corrcoef(inst['amp'][inst['type'] == 1], inst['amp'][inst['type'] == 2])[0, 1]
+                   for inst in (per_event, from_tables)]
+    assert correlation[0] < -0.5
+    assert abs(correlation[1] - correlation[0]) < 0.1
+
+
+def test_rand_instructions_seed():
+    """The same seed should give the same instructions for any number of workers"""
+    kwargs = dict(**_input_dict, seed=42, block_size=100)
+    inst = pema.rand_instructions(**kwargs)
+    assert inst.tobytes() == pema.rand_instructions(**kwargs, n_workers=2).tobytes()
+    assert inst.tobytes() != pema.rand_instructions(**{**kwargs, 'seed': 43}).tobytes()
+
+
+def test_inst_to_file():
+    """Instructions written to a .npy file should be the same when loaded"""
+    kwargs = dict(**_input_dict, seed=42, block_size=50)
+    inst = pema.rand_instructions(**kwargs)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        inst_file = os.path.join(temp_dir, 'inst.npy')
+        # The block_size is passed on to iter_rand_instructions
+        n_written = pema.inst_to_file(inst_file,
+                                      get_inst_from=pema.iter_rand_instructions,
+                                      rows_per_write=100,
+                                      **kwargs)
+        loaded = pema.load_instructions(inst_file)
+        assert n_written == len(loaded)
+        assert np.all(loaded == inst[inst['amp'] > 0])
+        assert pema.cached_instructions(temp_dir, **kwargs) == pema.cached_instructions(
+            temp_dir, **kwargs)
+
+
+def test_inst_to_file_failed():
+    """No (partial) file should be left if generating the instructions fails"""
+    def failing_instructions(**kwargs):
+        yield from pema.iter_rand_instructions(**kwargs, seed=42)
+        raise RuntimeError('Failed after the last chunk')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with pytest.raises(RuntimeError):
+            pema.cached_instructions(temp_dir, get_inst_from=failing_instructions,
+                                     **_input_dict)
+        assert not os.listdir(temp_dir)
+
+
+def test_iter_rand_instructions():
+    """The chunks should be the same as all instructions at once"""
+    kwargs = dict(**_input_dict, seed=42, block_size=30)
+    chunks = list(pema.iter_rand_instructions(**kwargs))
+    assert len(chunks) == _input_dict['n_chunk']
+    for chunk_i, chunk in enumerate(chunks):
+        assert np.all(chunk['event_number'] == chunk_i)
+    assert np.all(np.concatenate(chunks) == pema.rand_instructions(**kwargs))
+
+
+def test_kr83_instructions():
+    """Each event should be an S1, S2 and a delayed S1"""
+    kwargs = {k: v for k, v in _input_dict.items()
+              if k not in ('energy_range', 'nest_inst_types')}
+    inst = pema.kr83_instructions(**kwargs, seed=42)
+    per_event = inst.reshape(-1, 3)
+    assert np.all(per_event['type'] == [1, 2, 1])
+    assert np.all(per_event['time'][:, 2] >= per_event['time'][:, 0])
+    # The delay is not limited to the (default) range of the yield tables of NEST
+    delay = per_event['time'][:, 2] - per_event['time'][:, 0]
+    mean_life = pema.wfsim_utils.KR83M_HALF_LIFE / np.log(2)
+    assert abs(delay.mean() / mean_life - 1) < 0.1
+    assert np.all(per_event['x'] == per_event['x'][:, :1])
+    assert np.all(inst['amp'] > 0)
+    assert inst.tobytes() == pema.kr83_instructions(**kwargs, seed=42).tobytes()
+
+
+def test_kr83_instructions_cache():
+    """A fixed seed should give the same instructions with a cold or warm cache"""
+    kwargs = {k: v for k, v in _input_dict.items()
+              if k not in ('energy_range', 'nest_inst_types')}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cold = pema.kr83_instructions(**kwargs, yield_table_cache=temp_dir, seed=42)
+        assert len(os.listdir(temp_dir))
+        warm = pema.kr83_instructions(**kwargs, yield_table_cache=temp_dir, seed=42)
+    assert cold.tobytes() == warm.tobytes()
+    assert cold.tobytes() == pema.kr83_instructions(
+        **kwargs, yield_table_cache=None, seed=42).tobytes()